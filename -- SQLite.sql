@@ -17,6 +17,29 @@ DROP TABLE playlists;
 
 END TRANSACTION;
 
-CREATE INDEX playlists_options ON #FINISH THIS;
+CREATE UNIQUE INDEX playlist_tracks_playlist_track ON playlist_tracks (playlist_id, track_id);
+CREATE INDEX playlist_tracks_user ON playlist_tracks (user_id);
+CREATE INDEX playlists_user ON playlists (user_id);
+CREATE INDEX playlist_options_user ON playlist_options (user_id);
+CREATE INDEX users_username ON users (username);
 
-SELECT * FROM playlists WHERE playlist_id='25gN2E1Lbg6tUAvSyScmlt';
\ No newline at end of file
+SELECT * FROM playlists WHERE playlist_id='25gN2E1Lbg6tUAvSyScmlt';
+CREATE TABLE audio_features (track_id TEXT NOT NULL, mode INTEGER NOT NULL, key INTEGER NOT NULL, valence REAL NOT NULL, speechiness REAL NOT NULL, instrumentalness REAL NOT NULL, loudness REAL NOT NULL, energy REAL NOT NULL, danceability REAL NOT NULL, acousticness REAL NOT NULL, liveness REAL NOT NULL, tempo REAL NOT NULL, PRIMARY KEY(track_id));
+CREATE TABLE profile_sources (user_id INTEGER NOT NULL, source_id TEXT NOT NULL, track_id TEXT NOT NULL, PRIMARY KEY(user_id, source_id, track_id), FOREIGN KEY(user_id) REFERENCES users(id));
+CREATE TABLE user_profiles (user_id INTEGER NOT NULL, sums BLOB NOT NULL, counts BLOB NOT NULL, PRIMARY KEY(user_id), FOREIGN KEY(user_id) REFERENCES users(id));
+CREATE TABLE tokens (user_id INTEGER NOT NULL, token_info TEXT NOT NULL, PRIMARY KEY(user_id), FOREIGN KEY(user_id) REFERENCES users(id));
+ALTER TABLE playlist_options ADD COLUMN options TEXT;
+ALTER TABLE playlists ADD COLUMN snapshot_id TEXT;
+CREATE TABLE sessions (id TEXT NOT NULL, expires INTEGER NOT NULL, PRIMARY KEY(id));
+CREATE TABLE session_fields (session_id TEXT NOT NULL, field TEXT NOT NULL, value TEXT NOT NULL, PRIMARY KEY(session_id, field), FOREIGN KEY(session_id) REFERENCES sessions(id) ON DELETE CASCADE);
+CREATE INDEX sessions_expires ON sessions (expires);
+CREATE TABLE liked_songs (user_id INTEGER NOT NULL, track_id TEXT NOT NULL, added_at TEXT NOT NULL, name TEXT NOT NULL, album TEXT NOT NULL, artists TEXT NOT NULL, PRIMARY KEY(user_id, track_id), FOREIGN KEY(user_id) REFERENCES users(id));
+CREATE INDEX liked_songs_added ON liked_songs (user_id, added_at);
+CREATE TABLE liked_songs_syncs (user_id INTEGER NOT NULL, synced INTEGER NOT NULL, reconciled INTEGER NOT NULL, PRIMARY KEY(user_id), FOREIGN KEY(user_id) REFERENCES users(id));
+CREATE TABLE workers (id TEXT NOT NULL, expires INTEGER NOT NULL, PRIMARY KEY(id));
+CREATE TABLE playlist_leases (playlist_id TEXT NOT NULL, owner TEXT NOT NULL, expires INTEGER NOT NULL, PRIMARY KEY(playlist_id));
+CREATE INDEX playlist_leases_owner ON playlist_leases (owner);
+CREATE TABLE profile_history (user_id INTEGER NOT NULL, timestamp INTEGER NOT NULL, features BLOB NOT NULL, num_tracks INTEGER NOT NULL, num_sources INTEGER NOT NULL, PRIMARY KEY(user_id, timestamp), FOREIGN KEY(user_id) REFERENCES users(id)) WITHOUT ROWID;
+CREATE INDEX user_data_user_timestamp ON user_data (user_id, timestamp);
+CREATE TABLE audio_features_missing (track_id TEXT NOT NULL, checked INTEGER NOT NULL, PRIMARY KEY(track_id));
+CREATE TABLE profile_tracks (user_id INTEGER NOT NULL, track_id TEXT NOT NULL, PRIMARY KEY(user_id, track_id), FOREIGN KEY(user_id) REFERENCES users(id)) WITHOUT ROWID;
@@ -7,29 +7,45 @@
 
 
 import os
+import re
 import sys
+import secrets
 import time
 import math
+import calendar
+import heapq
+import bisect
+import sqlite3
+import itertools
+import contextvars
 import spotipy
 import threading
+import unicodedata
 import json
+import requests
+import numpy as np
 import spotipy.util as util
 
-from pprint import pprint
+from collections import OrderedDict, Counter, deque
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from random import sample, randrange
 from cs50 import SQL
-from flask import Flask, flash, redirect, render_template, request, session, url_for, jsonify
-from flask_session import Session
+from flask import Flask, flash, redirect, render_template, stream_template, request, session, url_for, jsonify, has_request_context, g, Response
+from flask.sessions import SessionInterface, SessionMixin
 from werkzeug.exceptions import default_exceptions, HTTPException, InternalServerError
 from os import environ
-from functools import wraps
+from functools import wraps, partial
+from contextlib import contextmanager
 from spotipy.oauth2 import SpotifyClientCredentials, SpotifyOAuth
+from spotipy.cache_handler import MemoryCacheHandler
+from urllib3.util.retry import Retry
 
 
 # Configure application and API keys
 app = Flask(__name__)
 SPOTIPY_CLIENT_ID = environ.get('SPOTIPY_CLIENT_ID')
 SPOTIPY_CLIENT_SECRET = environ.get('SPOTIPY_CLIENT_SECRET')
+SPOTIFY_API_PREFIX = environ.get('SPOTIFY_API_PREFIX', "https://api.spotify.com/v1/") # Can point at a local stand-in such as fake_spotify.py
 
 # Creates secret key and names session cookie
 app.secret_key = "GJOsgojhG08u9058hSDfj"
@@ -38,14 +54,376 @@ app.config["SESSION_COOKIE_NAME"] = "SpotiHelp Cookie"
 # Ensure templates are auto-reloaded
 app.config["TEMPLATES_AUTO_RELOAD"] = True
 
+# Configures instrumentation
+METRICS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10) # Upper bounds in seconds of the latency histograms
+SERVER_TIMING = environ.get('SPOTIHELP_SERVER_TIMING') == '1' # Adds a Server-Timing header with the time each response spent on Spotify and the database
+METRIC_SOURCE = contextvars.ContextVar('metric_source', default='other') # Route or background job the current work is done for
+REQUEST_TIMINGS = contextvars.ContextVar('request_timings', default=None) # (kind, seconds) of every call made for the current request
+SQL_TABLE = re.compile(r"\b(?:FROM|INTO|UPDATE)\s+(\w+)", re.I) # Finds the table a query works on
+SPOTIFY_ID = re.compile(r"(?<=/)[0-9A-Za-z]{22}(?=/|$)") # Finds Spotify ids in an endpoint
+
+
+# Keeps counters and latency histograms in memory and writes them out in the Prometheus text format
+class Metrics:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counters = Counter() # (name, labels) -> count
+        self.histograms = {} # (name, labels) -> [count in each bucket..., count above the last bucket, sum of all values]
+        self.lock = threading.Lock()
+
+    # Adds to a counter
+    def increment(self, name, labels, value=1):
+        with self.lock:
+            self.counters[(name, tuple(labels.items()))] += value
+
+    # Adds a duration to a histogram
+    def observe(self, name, labels, seconds):
+        key = (name, tuple(labels.items()))
+
+        with self.lock:
+            if key not in self.histograms:
+                self.histograms[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            self.histograms[key][bisect.bisect_left(self.buckets, seconds)] += 1
+            self.histograms[key][-1] += seconds
+
+    # Returns every metric in the Prometheus text format
+    def render(self):
+        with self.lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted((key, list(values)) for key, values in self.histograms.items())
+
+        lines = []
+        last_name = None
+        for (name, labels), value in counters:
+            if name != last_name:
+                lines.append(f"# TYPE {name} counter")
+                last_name = name
+            lines.append(f"{name}{format_labels(labels)} {value}")
+
+        for (name, labels), values in histograms:
+            if name != last_name:
+                lines.append(f"# TYPE {name} histogram")
+                last_name = name
+
+            # Prometheus buckets count every value up to their bound, including those in smaller buckets
+            total = 0
+            for bound, count in zip(self.buckets + ('+Inf',), values[:-1]):
+                total += count
+                lines.append(f"{name}_bucket{format_labels(labels + (('le', str(bound)),))} {total}")
+            lines.append(f"{name}_sum{format_labels(labels)} {values[-1]}")
+            lines.append(f"{name}_count{format_labels(labels)} {total}")
+
+        return "\n".join(lines) + "\n"
+
+
+# Formats metric labels, escaping the characters Prometheus doesn't allow in label values
+def format_labels(labels):
+    if not labels:
+        return ""
+
+    escaped = [(key, str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")) for key, value in labels]
+    return "{" + ",".join(f'{key}="{value}"' for key, value in escaped) + "}"
+
+
+METRICS = Metrics(METRICS_BUCKETS)
+
+
+# Records one Spotify call or database query, both for /metrics and for the current request's Server-Timing header
+# Errors are labelled with their HTTP status for Spotify calls (429 when rate limited) and their exception otherwise
+def record_call(kind, operation, seconds, error=None):
+    labels = {'source': METRIC_SOURCE.get(), 'operation': operation}
+    METRICS.increment(f"spotihelp_{kind}_calls_total", labels)
+    METRICS.observe(f"spotihelp_{kind}_call_seconds", labels, seconds)
+    if error:
+        METRICS.increment(f"spotihelp_{kind}_errors_total", dict(labels, error=error))
+
+    timings = REQUEST_TIMINGS.get()
+    if timings is not None:
+        timings.append((kind, seconds))
+
+    return
+
+
+# Returns the endpoint of a Spotify url with ids and user names left out, so that calls to the same endpoint are counted together
+def spotify_endpoint(method, url):
+    path = url.split("?")[0].split("/v1/")[-1].rstrip("/")
+    path = re.sub(r"^users/[^/]+", "users/{user}", path)
+    return f"{method} {SPOTIFY_ID.sub('{id}', path)}"
+
+
+# Thread pool whose tasks are counted towards the route or job that submitted them
+class ContextThreadPool(ThreadPoolExecutor):
+    def submit(self, fn, /, *args, **kwargs):
+        return super().submit(contextvars.copy_context().run, fn, *args, **kwargs)
+
+
+# Keeps a thread pool for each lane of the rate limiter, so that requests waiting behind the rate limit in a lower lane
+# can't take up the threads page views need
+class LanePool:
+    def __init__(self, max_workers, lanes):
+        self.pools = [ContextThreadPool(max_workers=max_workers, thread_name_prefix=f"fetch-{lane}") for lane in lanes]
+
+    # Runs fn in the pool of the current work's lane
+    def submit(self, fn, /, *args, **kwargs):
+        return self.pools[SPOTIFY_PRIORITY.get()].submit(fn, *args, **kwargs)
+
+    def map(self, fn, *iterables):
+        return self.pools[SPOTIFY_PRIORITY.get()].map(fn, *iterables)
+
+
 # Initializes database and globals
-db = SQL("sqlite:///spotihelp.db")
+DB_PATH = environ.get('SPOTIHELP_DB', "spotihelp.db")
 sp_oauth = None
 
+
+# Opens a connection for running several statements in one transaction, committing them all at the end
+@contextmanager
+def db_transaction():
+    start = time.perf_counter()
+    error = None
+    connection = sqlite3.connect(DB_PATH, timeout=30)
+    connection.execute("PRAGMA foreign_keys=ON")
+    connection.execute("PRAGMA synchronous=NORMAL") # Safe with WAL journaling, and avoids a disk sync per commit
+    try:
+        with connection:
+            yield connection
+    except Exception as e:
+        error = type(e).__name__
+        raise
+    finally:
+        connection.close()
+        record_call('db', 'transaction', time.perf_counter() - start, error)
+
+
+# Database object that times every query
+class InstrumentedSQL(SQL):
+    def execute(self, sql, *args, **kwargs):
+        table = SQL_TABLE.search(sql)
+        operation = sql.split(None, 1)[0].upper() + (" " + table.group(1) if table else "")
+        start = time.perf_counter()
+        error = None
+
+        try:
+            return super().execute(sql, *args, **kwargs)
+        except Exception as e:
+            error = type(e).__name__
+            raise
+        finally:
+            record_call('db', operation, time.perf_counter() - start, error)
+
+
+# Adds a column to a table unless it is already there
+def add_column(connection, table, column, definition):
+    if not connection.execute("SELECT name FROM pragma_table_info(?) WHERE name=?;", (table, column)).fetchall():
+        connection.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition};")
+
+
+# Migration 1: creates every table the app uses
+def migrate_tables(connection):
+    connection.execute("CREATE TABLE IF NOT EXISTS users (id INTEGER NOT NULL, username TEXT NOT NULL, PRIMARY KEY(id));")
+    connection.execute("""CREATE TABLE IF NOT EXISTS playlists (user_id INTEGER NOT NULL, playlist_id TEXT NOT NULL, playlist_name TEXT NOT NULL, playlist_link TEXT NOT NULL, 
+        is_smart TEXT NOT NULL, PRIMARY KEY(playlist_id), FOREIGN KEY(user_id) REFERENCES users(id));""")
+    connection.execute("""CREATE TABLE IF NOT EXISTS playlist_options (user_id INTEGER NOT NULL, playlist_id TEXT NOT NULL, auto_add INTEGER NOT NULL, replace INTEGER NOT NULL, 
+        allow_explicit INTEGER NOT NULL, PRIMARY KEY(playlist_id), FOREIGN KEY(playlist_id) REFERENCES playlists(playlist_id));""")
+    connection.execute("""CREATE TABLE IF NOT EXISTS playlist_tracks (user_id INTEGER NOT NULL, playlist_id TEXT NOT NULL, track_id TEXT NOT NULL, is_hearted INTEGER NOT NULL DEFAULT 0, 
+        num_skips INTEGER NOT NULL DEFAULT 0, row_id INTEGER NOT NULL, PRIMARY KEY(row_id), FOREIGN KEY(playlist_id) REFERENCES playlists(playlist_id));""")
+
+    # Audio features are shared between users, so each track is only ever analyzed once
+    connection.execute("""CREATE TABLE IF NOT EXISTS audio_features (track_id TEXT NOT NULL, mode INTEGER NOT NULL, key INTEGER NOT NULL, valence REAL NOT NULL, 
+        speechiness REAL NOT NULL, instrumentalness REAL NOT NULL, loudness REAL NOT NULL, energy REAL NOT NULL, danceability REAL NOT NULL, 
+        acousticness REAL NOT NULL, liveness REAL NOT NULL, tempo REAL NOT NULL, PRIMARY KEY(track_id));""")
+
+    # Listening profiles keep running sums of every feature over the unique tracks in a user's sources
+    connection.execute("""CREATE TABLE IF NOT EXISTS user_data (user_id INTEGER NOT NULL, transaction_id INTEGER NOT NULL, timestamp DATETIME DEFAULT CURRENT_TIMESTAMP NOT NULL, 
+        data TEXT NOT NULL, num_sources INTEGER NOT NULL, sources TEXT NOT NULL, PRIMARY KEY (transaction_id));""")
+    connection.execute("""CREATE TABLE IF NOT EXISTS profile_sources (user_id INTEGER NOT NULL, source_id TEXT NOT NULL, track_id TEXT NOT NULL, 
+        PRIMARY KEY(user_id, source_id, track_id), FOREIGN KEY(user_id) REFERENCES users(id));""")
+    connection.execute("""CREATE TABLE IF NOT EXISTS user_profiles (user_id INTEGER NOT NULL, sums BLOB NOT NULL, counts BLOB NOT NULL, 
+        PRIMARY KEY(user_id), FOREIGN KEY(user_id) REFERENCES users(id));""")
+
+    # Tokens are kept in the database so that smart playlists can be managed outside of a request
+    connection.execute("""CREATE TABLE IF NOT EXISTS tokens (user_id INTEGER NOT NULL, token_info TEXT NOT NULL, 
+        PRIMARY KEY(user_id), FOREIGN KEY(user_id) REFERENCES users(id));""")
+
+
+# Migration 2: adds columns to the original tables
+def migrate_columns(connection):
+    # Smart playlist options are stored as JSON so their managers can be rebuilt on startup
+    add_column(connection, 'playlist_options', 'options', 'TEXT')
+
+    # Snapshot ids tell whether a playlist changed since it was last synced
+    add_column(connection, 'playlists', 'snapshot_id', 'TEXT')
+
+
+# Migration 3: adds the indexes used by lookups and prevents a track from being stored twice in a playlist
+def migrate_indexes(connection):
+    connection.execute("DELETE FROM playlist_tracks WHERE row_id NOT IN (SELECT MIN(row_id) FROM playlist_tracks GROUP BY playlist_id, track_id);")
+    connection.execute("CREATE UNIQUE INDEX IF NOT EXISTS playlist_tracks_playlist_track ON playlist_tracks (playlist_id, track_id);")
+    connection.execute("CREATE INDEX IF NOT EXISTS playlist_tracks_user ON playlist_tracks (user_id);")
+    connection.execute("CREATE INDEX IF NOT EXISTS playlists_user ON playlists (user_id);")
+    connection.execute("CREATE INDEX IF NOT EXISTS playlist_options_user ON playlist_options (user_id);")
+    connection.execute("CREATE INDEX IF NOT EXISTS users_username ON users (username);")
+
+
+# Migration 4: stores sessions on the server so that the cookie only carries their id
+def migrate_sessions(connection):
+    connection.execute("CREATE TABLE IF NOT EXISTS sessions (id TEXT NOT NULL, expires INTEGER NOT NULL, PRIMARY KEY(id));")
+    connection.execute("""CREATE TABLE IF NOT EXISTS session_fields (session_id TEXT NOT NULL, field TEXT NOT NULL, value TEXT NOT NULL, 
+        PRIMARY KEY(session_id, field), FOREIGN KEY(session_id) REFERENCES sessions(id) ON DELETE CASCADE);""")
+    connection.execute("CREATE INDEX IF NOT EXISTS sessions_expires ON sessions (expires);")
+
+
+# Migration 5: keeps a copy of every user's liked songs so that only new ones have to be fetched
+def migrate_liked_songs(connection):
+    connection.execute("""CREATE TABLE IF NOT EXISTS liked_songs (user_id INTEGER NOT NULL, track_id TEXT NOT NULL, added_at TEXT NOT NULL, name TEXT NOT NULL, 
+        album TEXT NOT NULL, artists TEXT NOT NULL, PRIMARY KEY(user_id, track_id), FOREIGN KEY(user_id) REFERENCES users(id));""")
+    connection.execute("CREATE INDEX IF NOT EXISTS liked_songs_added ON liked_songs (user_id, added_at);")
+    connection.execute("""CREATE TABLE IF NOT EXISTS liked_songs_syncs (user_id INTEGER NOT NULL, synced INTEGER NOT NULL, reconciled INTEGER NOT NULL, 
+        PRIMARY KEY(user_id), FOREIGN KEY(user_id) REFERENCES users(id));""")
+
+
+# Migration 6: lets worker processes share smart playlists, each playlist being managed by the worker holding its lease
+def migrate_leases(connection):
+    connection.execute("CREATE TABLE IF NOT EXISTS workers (id TEXT NOT NULL, expires INTEGER NOT NULL, PRIMARY KEY(id));")
+    connection.execute("CREATE TABLE IF NOT EXISTS playlist_leases (playlist_id TEXT NOT NULL, owner TEXT NOT NULL, expires INTEGER NOT NULL, PRIMARY KEY(playlist_id));")
+    connection.execute("CREATE INDEX IF NOT EXISTS playlist_leases_owner ON playlist_leases (owner);")
+
+
+# Migration 7: keeps every snapshot of a listening profile as a packed vector of features, ordered by time within each user
+def migrate_profile_history(connection):
+    connection.execute("""CREATE TABLE IF NOT EXISTS profile_history (user_id INTEGER NOT NULL, timestamp INTEGER NOT NULL, features BLOB NOT NULL, 
+        num_tracks INTEGER NOT NULL, num_sources INTEGER NOT NULL, PRIMARY KEY(user_id, timestamp), FOREIGN KEY(user_id) REFERENCES users(id)) WITHOUT ROWID;""")
+    connection.execute("CREATE INDEX IF NOT EXISTS user_data_user_timestamp ON user_data (user_id, timestamp);")
+
+    # Carries over the snapshots stored as JSON so far, with the features in the order of AUDIO_FEATURES
+    order = ['mode', 'key', 'valence', 'speechiness', 'instrumentalness', 'loudness', 'energy', 'danceability', 'acousticness', 'liveness', 'tempo']
+    rows = []
+    for transaction_id, user_id, timestamp, data, num_sources in connection.execute("SELECT transaction_id, user_id, timestamp, data, num_sources FROM user_data WHERE user_id IN (SELECT id FROM users) ORDER BY transaction_id;"):
+        # Skips snapshots that can't be read instead of leaving the database unmigrated
+        try:
+            features = json.loads(data)['audio_features']
+            vector = np.array([features.get(feature, 0) for feature in order], dtype=np.float32)
+            rows.append((user_id, calendar.timegm(time.strptime(timestamp, "%Y-%m-%d %H:%M:%S")), vector.tobytes(), 0, num_sources))
+        except (ValueError, TypeError, KeyError, AttributeError) as e:
+            print(f"Skipping unreadable user data {transaction_id}: {e!r}")
+    connection.executemany("INSERT OR REPLACE INTO profile_history (user_id, timestamp, features, num_tracks, num_sources) VALUES (?,?,?,?,?);", rows)
+
+
+# Migration 8: remembers the tracks Spotify couldn't analyze so that they aren't asked about on every call
+def migrate_missing_features(connection):
+    connection.execute("CREATE TABLE IF NOT EXISTS audio_features_missing (track_id TEXT NOT NULL, checked INTEGER NOT NULL, PRIMARY KEY(track_id));")
+
+
+# Migration 9: records which tracks make up each profile's sums, so that tracks analyzed after they joined a source can be counted later
+# Existing profiles are rebuilt from the tracks that have features now, since their sums may already have drifted
+def migrate_profile_tracks(connection):
+    connection.execute("""CREATE TABLE IF NOT EXISTS profile_tracks (user_id INTEGER NOT NULL, track_id TEXT NOT NULL, 
+        PRIMARY KEY(user_id, track_id), FOREIGN KEY(user_id) REFERENCES users(id)) WITHOUT ROWID;""")
+    connection.execute("""INSERT OR IGNORE INTO profile_tracks (user_id, track_id) 
+        SELECT DISTINCT user_id, track_id FROM profile_sources WHERE track_id IN (SELECT track_id FROM audio_features);""")
+
+    order = ['mode', 'key', 'valence', 'speechiness', 'instrumentalness', 'loudness', 'energy', 'danceability', 'acousticness', 'liveness', 'tempo']
+    rows = []
+    for user_id, count, *sums in connection.execute("SELECT user_id, COUNT(*), " + ", ".join(f"SUM({feature})" for feature in order) + 
+                                                    " FROM profile_tracks JOIN audio_features USING (track_id) GROUP BY user_id;"):
+        rows.append((user_id, np.array(sums, dtype=np.float64).tobytes(), np.full(len(order), count, dtype=np.float64).tobytes()))
+    connection.execute("DELETE FROM user_profiles;")
+    connection.executemany("INSERT INTO user_profiles (user_id, sums, counts) VALUES (?,?,?);", rows)
+
+
+MIGRATIONS = [migrate_tables, migrate_columns, migrate_indexes, migrate_sessions, migrate_liked_songs, migrate_leases, migrate_profile_history, migrate_missing_features, 
+              migrate_profile_tracks]
+
+
+# Brings the database up to the latest schema, running each migration once
+def migrate_db():
+    open(DB_PATH, 'a').close() # Creates the database file if it doesn't exist
+
+    # Lets web requests and playlist managers read while another thread writes
+    connection = sqlite3.connect(DB_PATH, timeout=30)
+    connection.execute("PRAGMA journal_mode=WAL;")
+    connection.close()
+
+    with db_transaction() as connection:
+        connection.execute("BEGIN IMMEDIATE;") # Stops another process from migrating at the same time
+        version = connection.execute("PRAGMA user_version;").fetchone()[0]
+
+        for number, migration in enumerate(MIGRATIONS[version:], start=version + 1):
+            migration(connection)
+            connection.execute(f"PRAGMA user_version={number};")
+
+    return
+
+
+migrate_db()
+db = InstrumentedSQL("sqlite:///" + DB_PATH)
+
 # Globals
 KEY = ['C', 'C#', 'D', 'D#', 'E', 'F', 'F#', 'G', 'G#', 'A', 'A#', 'B'] # Conversion values for keys
 MODE = ['Major', 'Minor'] # Conversion values for mode
-THREADS = {}
+AUDIO_FEATURES = ['mode', 'key', 'valence', 'speechiness', 'instrumentalness', 'loudness', 'energy', 'danceability', 'acousticness', 'liveness', 'tempo'] # Features stored for every track
+AUDIO_FEATURES_BATCH = 100 # Maximum number of tracks Spotify analyzes per request
+MISSING_FEATURES_RETRY = 30 * 86400 # Seconds before Spotify is asked again about a track it couldn't analyze
+FEATURE_RANGES = {'mode': (0, 1), 'key': (0, 11), 'loudness': (-60, 0), 'tempo': (0, 250)} # Range of the features that don't go from 0 to 1, used to put them on the same scale
+FEATURE_WEIGHTS = {'mode': 0, 'key': 0} # Weight of features in the distance between tracks (default 1), key and mode are only used as filters
+LOCAL_CANDIDATE_SHARE = 0.5 # Fraction of new candidates taken from similar tracks the app already knows instead of asking Spotify
+SCHEDULER_WORKERS = 4 # Number of threads that run smart playlist jobs
+RECOMMENDATION_LIMIT = 100 # Maximum number of tracks Spotify recommends per request
+RECOMMENDATION_FANOUT = 5 # Number of recommendation requests sent at the same time
+RECOMMENDATION_CACHE_SIZE = 2048 # Number of recommendation responses kept in memory
+RECOMMENDATION_CACHE = OrderedDict() # Seed parameters -> recommended track ids, least recently used first
+RECOMMENDATION_CACHE_LOCK = threading.Lock()
+CANDIDATE_LOW_WATER = 20 # Number of queued candidates below which a smart playlist's buffer is refilled
+SKIP_THRESHOLD = 0.5 # Fraction of a track that has to be played for it not to count as skipped
+PLAYBACK_POLL_MIN = 2 # Shortest time in seconds between two playback checks
+PLAYBACK_POLL_MAX = 30 # Longest time in seconds between two playback checks while a track is playing
+PLAYBACK_POLL_IDLE = 60 # Time in seconds between playback checks while nothing is playing
+SKIP_FLUSH_INTERVAL = 30 # Seconds between two writes of logged skips to the database
+CLIENT_POOL_SIZE = 1000 # Maximum number of users with a pooled spotify object
+TOKEN_REFRESH_MARGIN = 60 # Seconds before expiry at which a token is refreshed on use
+TOKEN_REFRESH_AHEAD = 300 # Seconds before expiry at which a token is refreshed in the background
+TOKEN_REFRESH_IDLE = 3600 # Seconds after its last use at which a token stops being refreshed in the background
+JOB_WORKERS = 2 # Number of threads that run work started from a page, like creating a playlist
+JOB_RETENTION = 600 # Seconds the progress of a finished job is kept for the browser to read
+JOB_KEEPALIVE = 15 # Seconds between two messages on an idle progress stream
+EDITOR_PAGE_SIZE = 100 # Tracks shown at a time in the playlist editor, the most Spotify returns per request
+TRACK_FIELDS = "track(id,name,album(name),artists(name))" # Only the parts of a playlist item kept in a Track
+LIKED_SONGS_PAGE = 50 # Most liked songs Spotify returns per request
+LIKED_SONGS_RECONCILE = 86400 # Seconds after which a user's liked songs are fetched in full again, to catch songs they unliked
+LEASE_DURATION = 90 # Seconds a worker keeps its smart playlists without renewing their leases
+LEASE_HEARTBEAT = 30 # Seconds between two renewals of a worker's leases, which is also when it takes new or abandoned playlists
+WORKER_ID = f"{os.uname().nodename}-{os.getpid()}-{secrets.token_hex(4)}" # Name of this process in the lease tables
+HISTORY_BUCKETS = {'day': (86400, 0), 'week': (604800, 3 * 86400)} # Length and offset in seconds of profile history rollups, weeks starting on Monday
+SEARCH_LIMIT = 10 # Number of artists returned by a search
+SEARCH_CACHE_SIZE = 1024 # Number of searches kept in memory
+SEARCH_CACHE_TTL = 600 # Seconds a search is answered from memory
+SESSION_LIFETIME = 30 * 86400 # Seconds a session lasts after it was last renewed
+SESSION_RENEW_AFTER = 86400 # Seconds after which a session in use is renewed
+SESSION_ID = re.compile(r"[A-Za-z0-9_-]{43}") # Session ids made by secrets.token_urlsafe(32)
+
+# Keep-alive connections to Spotify shared by every spotify object
+# 429 responses are left to the rate limiter, which makes every request wait them out instead of just the one that got it
+# POSTs aren't retried, since adding tracks twice would duplicate them in the playlist
+HTTP_SESSION = requests.Session()
+HTTP_ADAPTER = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=32, max_retries=Retry(
+    total=3, connect=None, read=False, allowed_methods=frozenset(['GET', 'PUT', 'DELETE']), 
+    status=3, backoff_factor=0.3, status_forcelist=(500, 502, 503, 504), respect_retry_after_header=False))
+HTTP_SESSION.mount('https://', HTTP_ADAPTER)
+HTTP_SESSION.mount('http://', HTTP_ADAPTER)
+SPOTIFY_RATE_LIMIT = float(environ.get('SPOTIFY_RATE_LIMIT', 20)) # Requests per second each process sends to Spotify, so split it between the web process and the workers
+SPOTIFY_RATE_BURST = 40 # Requests that can be sent at once after a quiet period
+PRIORITY_INTERACTIVE, PRIORITY_CREATION, PRIORITY_BACKGROUND = 0, 1, 2 # Lanes of the rate limiter, served in this order
+PRIORITY_NAMES = ['interactive', 'creation', 'background']
+PRIORITY_RESERVES = [0, 5, 15] # Requests of the burst each lane has to leave for the lanes before it, so background work backs off first
+PRIORITY_MAX_PAUSES = [5, None, None] # Longest Retry-After pause each lane waits out before giving up (None: no limit), so pages don't hang on a long one
+SPOTIFY_PRIORITY = contextvars.ContextVar('spotify_priority', default=PRIORITY_BACKGROUND) # Lane of the current work's requests
+FETCH_WORKERS = 8 # Maximum number of Spotify pages requested at the same time in each lane
+FETCH_POOL = LanePool(FETCH_WORKERS, PRIORITY_NAMES) # Shared pools for concurrent Spotify requests
+REFILL_POOL = ContextThreadPool(max_workers=2, thread_name_prefix="refill") # Background candidate refills, which fetch through FETCH_POOL themselves
+RATE_LIMIT_RETRIES = 3 # Times a request is retried after Spotify answers 429
+SPOTIFY_CACHE_SIZE = 64 * 1024 * 1024 # Bytes of Spotify responses kept in memory
+SPOTIFY_CACHE_TTLS = {'GET me': 3600, 'GET audio-features': 86400, 'GET recommendations': 3600, 'GET search': 600, 'GET artists/{id}': 86400,
+                      'GET me/player': None, 'GET me/player/currently-playing': None} # Seconds a response is used without asking Spotify (None: never cached, default: always revalidated)
 
 
 # Application
@@ -64,11 +442,17 @@ def login_required(f):
 
 
 # Creates a spotify authorization object
+# Outside of a request (when refreshing tokens for smart playlists) the redirect url is read from the environment
 def create_spotify_oauth():
+    if has_request_context():
+        redirect_uri = url_for('redirectPage',_external=True)
+    else:
+        redirect_uri = environ.get('SPOTIPY_REDIRECT_URI')
+
     return SpotifyOAuth(
         client_id=SPOTIPY_CLIENT_ID,
         client_secret=SPOTIPY_CLIENT_SECRET,
-        redirect_uri=url_for('redirectPage',_external=True),
+        redirect_uri=redirect_uri,
         scope="""ugc-image-upload user-read-recently-played user-read-playback-state 
         user-top-read app-remote-control playlist-modify-public user-modify-playback-state 
         playlist-modify-private user-follow-modify user-read-currently-playing user-follow-read 
@@ -76,26 +460,535 @@ def create_spotify_oauth():
         user-read-private user-library-read playlist-read-collaborative streaming""")
 
 
-# Returns a valid access token, refreshing it if needed
-def get_token():
-    token_info = session.get("token_info", None) # Gives token information if it exists, otherwise given 'None'
+# Raised instead of waiting when Spotify asked for a longer pause than the current lane waits out
+class SpotifyBusy(Exception):
+    def __init__(self, retry_after):
+        super().__init__(f"Spotify asked to wait {retry_after:.0f} seconds")
+        self.retry_after = retry_after
+
+
+# Spaces out the process's requests to Spotify with a token bucket shared by every user and background job in it
+# The bucket isn't shared between processes, so the web process and each worker process have their own
+# Waiting requests are let through by lane, and after a 429 everyone waits until Spotify's Retry-After has passed, except lanes that give up on long pauses
+# Each 429 also halves the rate, which is earned back a little with every request that goes through
+class RateLimiter:
+    def __init__(self, rate, burst, reserves, max_pauses):
+        self.max_rate = rate
+        self.rate = rate
+        self.burst = burst
+        self.reserves = reserves
+        self.max_pauses = max_pauses
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.paused_until = 0
+        self.waiting = [] # Heap of (lane, sequence number) of waiting requests
+        self.sequence = itertools.count()
+        self.condition = threading.Condition()
+
+    # Adds the tokens gained since the last update
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    # Waits until a request in the given lane can be sent
+    # Only the first request in line can take a token, and it has to leave its lane's reserve in the bucket
+    def acquire(self, priority):
+        start = time.monotonic()
+
+        with self.condition:
+            ticket = (priority, next(self.sequence))
+            heapq.heappush(self.waiting, ticket)
+
+            try:
+                while True:
+                    self.refill()
+                    wait = self.paused_until - time.monotonic()
+                    if self.max_pauses[priority] is not None and wait > self.max_pauses[priority]:
+                        raise SpotifyBusy(wait)
+
+                    if wait <= 0 and self.waiting[0] == ticket:
+                        if self.tokens - 1 >= self.reserves[priority]:
+                            self.tokens -= 1
+                            self.rate = min(self.max_rate, self.rate + self.max_rate / 100)
+                            break
+                        wait = (self.reserves[priority] + 1 - self.tokens) / self.rate
+                    elif wait <= 0:
+                        wait = None # Waits for the requests ahead in line
+
+                    self.condition.wait(wait)
+            finally:
+                self.waiting.remove(ticket)
+                heapq.heapify(self.waiting)
+                self.condition.notify_all()
+
+        METRICS.observe("spotihelp_spotify_wait_seconds", {'lane': PRIORITY_NAMES[priority]}, time.monotonic() - start)
+
+    # Stops every request for the given number of seconds and starts again slower, with an empty bucket
+    def pause(self, seconds):
+        with self.condition:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+            self.rate = max(self.rate / 2, 1)
+            self.tokens = 0
+            self.updated = time.monotonic()
+
+
+RATE_LIMITER = RateLimiter(SPOTIFY_RATE_LIMIT, SPOTIFY_RATE_BURST, PRIORITY_RESERVES, PRIORITY_MAX_PAUSES)
+
+
+# Sends a request to Spotify once the rate limiter lets it through, waiting out and retrying 429 responses
+def send_to_spotify(method, url, **kwargs):
+    for attempt in range(RATE_LIMIT_RETRIES + 1):
+        RATE_LIMITER.acquire(SPOTIFY_PRIORITY.get())
+        response = HTTP_SESSION.request(method, url, **kwargs)
+        if response.status_code != 429 or attempt == RATE_LIMIT_RETRIES:
+            return response
+
+        METRICS.increment("spotihelp_spotify_rate_limited_total", {'lane': PRIORITY_NAMES[SPOTIFY_PRIORITY.get()]})
+        try:
+            retry_after = float(response.headers.get('Retry-After', 1))
+        except ValueError:
+            retry_after = 1
+        RATE_LIMITER.pause(retry_after)
+
+
+# Keeps Spotify GET responses in memory, least recently used first, up to a total size in bytes
+class ResponseCache:
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.entries = OrderedDict() # (user id, url) -> [etag, body, time the body can be used until without revalidating, user's write count when stored]
+        self.writes = Counter() # User id -> number of changes the user made on Spotify, which makes their stored responses stale
+        self.lock = threading.Lock()
+
+    # Returns the stored response for a url, if there is one
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry:
+                self.entries.move_to_end(key)
+            return entry
+
+    # Checks if a stored response can be used without asking Spotify
+    def is_fresh(self, key, entry):
+        return entry[2] > time.time() and entry[3] == self.writes[key[0]]
+
+    # Stores a response, evicting the least recently used ones once the cache is full
+    def put(self, key, etag, body, ttl):
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old:
+                self.bytes -= len(old[1])
+
+            self.entries[key] = [etag, body, time.time() + ttl, self.writes[key[0]]]
+            self.bytes += len(body)
+
+            while self.bytes > self.max_bytes:
+                evicted = self.entries.popitem(last=False)[1]
+                self.bytes -= len(evicted[1])
+
+    # Marks a stored response as valid again after Spotify said it hasn't changed
+    def refresh(self, key, entry, ttl):
+        with self.lock:
+            entry[2] = time.time() + ttl
+            entry[3] = self.writes[key[0]]
+
+    # Makes every response stored for a user get revalidated, after they changed something on Spotify
+    def invalidate(self, user_id):
+        with self.lock:
+            self.writes[user_id] += 1
+
+
+SPOTIFY_CACHE = ResponseCache(SPOTIFY_CACHE_SIZE)
+
+
+# Sends a user's requests through the rate limiter over the shared keep-alive connections, answering GETs from the cache where possible
+# Stored responses are revalidated with If-None-Match, so an unchanged resource costs an empty 304 instead of its whole body
+class CachedSession:
+    def __init__(self, user_id):
+        self.user_id = user_id
+
+    def request(self, method, url, headers=None, params=None, **kwargs):
+        if self.user_id is None:
+            return send_to_spotify(method, url, headers=headers, params=params, **kwargs)
+
+        if method != 'GET':
+            SPOTIFY_CACHE.invalidate(self.user_id)
+            return send_to_spotify(method, url, headers=headers, params=params, **kwargs)
+
+        ttl = SPOTIFY_CACHE_TTLS.get(spotify_endpoint(method, url), 0)
+        if ttl is None:
+            return send_to_spotify(method, url, headers=headers, params=params, **kwargs)
+
+        key = (self.user_id, requests.Request(method, url, params=params).prepare().url)
+        entry = SPOTIFY_CACHE.get(key)
+        if entry and SPOTIFY_CACHE.is_fresh(key, entry):
+            METRICS.increment("spotihelp_spotify_cache_total", {'result': 'hit'})
+            return cached_response(key[1], entry[1])
+
+        headers = dict(headers or {})
+        if entry and entry[0]:
+            headers['If-None-Match'] = entry[0]
+        response = send_to_spotify(method, url, headers=headers, params=params, **kwargs)
+
+        if response.status_code == 304 and entry:
+            METRICS.increment("spotihelp_spotify_cache_total", {'result': 'revalidated'})
+            SPOTIFY_CACHE.refresh(key, entry, ttl)
+            return cached_response(key[1], entry[1])
+
+        METRICS.increment("spotihelp_spotify_cache_total", {'result': 'miss'})
+        # Only responses that can be revalidated or reused for a while are worth storing
+        if response.status_code == 200 and (response.headers.get('ETag') or ttl):
+            SPOTIFY_CACHE.put(key, response.headers.get('ETag'), response.content, ttl)
+
+        return response
+
+
+# Builds a response from a stored body for spotipy to read
+def cached_response(url, body):
+    response = requests.Response()
+    response.status_code = 200
+    response.url = url
+    response.encoding = 'utf-8'
+    response.headers['Content-Type'] = 'application/json'
+    response._content = body
+
+    return response
+
+
+# Saves a user's token so it can be used by background jobs
+def store_token(user_id, token_info):
+    db.execute("INSERT OR REPLACE INTO tokens (user_id, token_info) VALUES (?,?);", user_id, json.dumps(token_info))
 
-    # Checks if token_info is 'None' and redirects user to login
-    if not token_info:
-        return redirect(url_for("login", _external=True))
+    return
 
-    # Checks if token is close to expiring
-    now = int(time.time()) # Gets current time
-    is_expired = (token_info['expires_at'] - now) < 60 # T or F depending on condition
 
-    # If the token is close to expiring, refresh it
-    if is_expired:
-        sp_oauth = create_spotify_oauth() 
-        token_info = sp_oauth.refresh_access_token(token_info['refresh_token'])
-    
-    session['token_info'] = token_info
+# Returns a user's stored token, or None if they have none
+def load_token(user_id):
+    rows = db.execute("SELECT token_info FROM tokens WHERE user_id=?;", user_id)
+    return json.loads(rows[0]['token_info']) if rows else None
+
+
+# Keeps a user's access token valid for their pooled spotify object
+# Callers that find the token expiring wait on a single refresh instead of each refreshing it
+# Other processes refresh the same tokens, so the stored token is checked for a newer one before asking Spotify
+class UserToken:
+    def __init__(self, user_id, token_info):
+        self.user_id = user_id
+        self.token_info = token_info
+        self.used = time.monotonic()
+        self.lock = threading.Lock()
+
+    # Checks if the token expires within the given number of seconds
+    def expires_within(self, seconds):
+        return (self.token_info['expires_at'] - int(time.time())) < seconds
+
+    # Refreshes the token unless another caller already did while this one was waiting
+    def refresh(self, margin=TOKEN_REFRESH_MARGIN):
+        with self.lock:
+            if self.expires_within(margin):
+                stored = load_token(self.user_id)
+                if stored and stored['expires_at'] > self.token_info['expires_at']:
+                    self.token_info = stored
+
+            if self.expires_within(margin):
+                sp_oauth = create_spotify_oauth()
+                self.token_info = sp_oauth.refresh_access_token(self.token_info['refresh_token'])
+                store_token(self.user_id, self.token_info)
+
+    # Called by spotipy before every request
+    def get_access_token(self, as_dict=False):
+        self.used = time.monotonic()
+        if self.expires_within(TOKEN_REFRESH_MARGIN):
+            self.refresh()
+        return self.token_info if as_dict else self.token_info['access_token']
+
+
+# Spotify object that leaves the shared connections open when it is discarded
+# Given a user id, it answers that user's GET requests from the response cache where possible
+class PooledSpotify(spotipy.Spotify):
+    def __init__(self, *args, user_id=None, **kwargs):
+        super().__init__(*args, requests_session=HTTP_SESSION, **kwargs)
+        self.prefix = SPOTIFY_API_PREFIX
+        self._session = CachedSession(user_id)
+
+    def __del__(self):
+        pass
 
-    return token_info
+    # Times every call to Spotify
+    def _internal_call(self, method, url, payload, params):
+        start = time.perf_counter()
+        error = None
+
+        try:
+            return super()._internal_call(method, url, payload, params)
+        except spotipy.SpotifyException as e:
+            error = str(e.http_status)
+            raise
+        except Exception as e:
+            error = type(e).__name__
+            raise
+        finally:
+            record_call('spotify', spotify_endpoint(method, url), time.perf_counter() - start, error)
+
+
+# Hands out one reusable spotify object per user, all sharing the same keep-alive connections
+class SpotifyClientPool:
+    def __init__(self, size):
+        self.size = size
+        self.clients = OrderedDict() # User id -> spotify object, least recently used first
+        self.lock = threading.Lock()
+
+    # Returns the user's spotify object, creating it from their stored token if needed
+    def get(self, user_id):
+        with self.lock:
+            sp = self.clients.get(user_id)
+            if sp is not None:
+                self.clients.move_to_end(user_id)
+                return sp
+
+        token_info = json.loads(db.execute("SELECT token_info FROM tokens WHERE user_id=?;", user_id)[0]['token_info'])
+        return self.add(user_id, token_info)
+
+    # Gives a user a spotify object using a new token
+    def add(self, user_id, token_info):
+        sp = PooledSpotify(auth_manager=UserToken(user_id, token_info), user_id=user_id)
+
+        with self.lock:
+            # Keeps the existing object if another thread created one first, so it has only one token to refresh
+            if user_id in self.clients:
+                self.clients[user_id].auth_manager.token_info = token_info
+                sp = self.clients[user_id]
+            else:
+                self.clients[user_id] = sp
+                if len(self.clients) > self.size:
+                    self.clients.popitem(last=False)
+        
+        return sp
+
+    # Refreshes tokens that are about to expire so requests never wait for a refresh
+    # Tokens that haven't been used for a while are left to be refreshed on their next use
+    def refresh_expiring(self):
+        with self.lock:
+            tokens = [sp.auth_manager for sp in self.clients.values()]
+
+        for token in tokens:
+            if token.expires_within(TOKEN_REFRESH_AHEAD) and time.monotonic() - token.used < TOKEN_REFRESH_IDLE:
+                try:
+                    token.refresh(TOKEN_REFRESH_AHEAD)
+                except Exception as e:
+                    print(f"Could not refresh token of user {token.user_id}: {e!r}")
+
+
+CLIENTS = SpotifyClientPool(CLIENT_POOL_SIZE)
+APP_CLIENT = {} # Spotify object that isn't tied to a user, made on first use
+APP_CLIENT_LOCK = threading.Lock()
+
+
+# Returns the spotify object that uses the app's own credentials, which keeps its token in memory and renews it when it expires
+def get_app_client():
+    with APP_CLIENT_LOCK:
+        if 'sp' not in APP_CLIENT:
+            APP_CLIENT['sp'] = PooledSpotify(client_credentials_manager=SpotifyClientCredentials(
+                client_id=SPOTIPY_CLIENT_ID, client_secret=SPOTIPY_CLIENT_SECRET, cache_handler=MemoryCacheHandler()))
+        return APP_CLIENT['sp']
+
+
+# Keeps recent artist searches in memory, least recently used first
+# A search is also answered from an earlier search for the start of its query, when that one returned every match Spotify had
+class SearchCache:
+    def __init__(self, size, ttl):
+        self.size = size
+        self.ttl = ttl
+        self.entries = OrderedDict() # Normalized query -> (expiry time, artists, whether every match was returned)
+        self.lock = threading.Lock()
+
+    # Returns the cached artists for a normalized query, or None if it has to be asked to Spotify
+    def get(self, query):
+        now = time.time()
+        with self.lock:
+            entry = self.entries.get(query)
+            if entry and entry[0] > now:
+                self.entries.move_to_end(query)
+                METRICS.increment("spotihelp_search_cache_total", {'result': 'hit'})
+                return entry[1]
+
+            # Narrows down the longest complete search for a prefix of the query
+            for length in range(len(query) - 1, 0, -1):
+                entry = self.entries.get(query[:length])
+                if entry and entry[0] > now and entry[2]:
+                    METRICS.increment("spotihelp_search_cache_total", {'result': 'prefix'})
+                    return [artist for artist in entry[1] if query in normalize_query(artist['name'])]
+
+        METRICS.increment("spotihelp_search_cache_total", {'result': 'miss'})
+        return None
+
+    def put(self, query, artists, complete):
+        with self.lock:
+            self.entries[query] = (time.time() + self.ttl, artists, complete)
+            self.entries.move_to_end(query)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+
+SEARCH_CACHE = SearchCache(SEARCH_CACHE_SIZE, SEARCH_CACHE_TTL)
+
+
+# Lowercases a search, strips its accents and collapses its whitespace, so that searches differing only in those share a cache entry
+# Spotify ignores accents too, so names narrowed down from an earlier search still match the way Spotify would match them
+def normalize_query(query):
+    query = "".join(char for char in unicodedata.normalize('NFKD', query) if not unicodedata.combining(char))
+    return " ".join(query.casefold().split())
+
+
+# Returns the artists matching a search, with only the fields pages show
+def search_artists(query):
+    query = normalize_query(query)
+    if not query:
+        return []
+
+    artists = SEARCH_CACHE.get(query)
+    if artists is None:
+        results = get_app_client().search(q='artist:' + query, type='artist', limit=SEARCH_LIMIT)['artists']
+        artists = [{'id': artist['id'], 'name': artist['name'], 'image': artist['images'][-1]['url'] if artist['images'] else None, 
+                    'followers': artist['followers']['total'], 'popularity': artist['popularity'], 'link': artist['external_urls']['spotify']} 
+                   for artist in results['items']]
+        SEARCH_CACHE.put(query, artists, results['total'] <= len(results['items']))
+
+    return artists
+
+
+# A session that keeps only its id in the cookie and reads each field from the database the first time it is used
+# Changed fields are written when the request ends, and clearing the session gives it a new id
+class ServerSession(SessionMixin):
+    permanent = True # Server-side sessions always expire after SESSION_LIFETIME
+
+    def __init__(self, session_id=None):
+        self.session_id = session_id
+        self.expires = None
+        self.fields = {} # Field -> value of the fields read or changed so far
+        self.missing = set() # Fields known not to be stored
+        self.changed = set() # Fields to write, or to delete if they are no longer in fields
+        self.complete = session_id is None # Whether every stored field has been read
+        self.cleared = False
+        self.modified = False
+        self.accessed = False
+
+    # Reads one field (or every field) of the session from the database
+    # A session that expired or doesn't exist is treated as a new, empty one
+    def load(self, field=None):
+        if field is None:
+            rows = db.execute("""SELECT sessions.expires, session_fields.field, session_fields.value FROM sessions LEFT JOIN session_fields ON session_fields.session_id = sessions.id 
+                              WHERE sessions.id=? AND sessions.expires > ?;""", self.session_id, int(time.time()))
+        else:
+            rows = db.execute("""SELECT sessions.expires, session_fields.field, session_fields.value FROM sessions LEFT JOIN session_fields ON session_fields.session_id = sessions.id AND session_fields.field=? 
+                              WHERE sessions.id=? AND sessions.expires > ?;""", field, self.session_id, int(time.time()))
+
+        if not rows:
+            self.session_id = None
+            self.complete = True
+            return
+
+        self.expires = rows[0]['expires']
+        for row in rows:
+            if row['field'] is not None and row['field'] not in self.changed:
+                self.fields[row['field']] = json.loads(row['value'])
+        if field is None:
+            self.complete = True
+        elif field not in self.fields:
+            self.missing.add(field)
+
+    def __getitem__(self, field):
+        self.accessed = True
+        if field not in self.fields and field not in self.missing and not self.complete:
+            self.load(field)
+        return self.fields[field]
+
+    def __setitem__(self, field, value):
+        self.fields[field] = value
+        self.missing.discard(field)
+        self.changed.add(field)
+        self.modified = True
+
+    def __delitem__(self, field):
+        self[field] # Raises a KeyError if the field isn't stored
+        del self.fields[field]
+        self.missing.add(field)
+        self.changed.add(field)
+        self.modified = True
+
+    def __iter__(self):
+        self.accessed = True
+        if not self.complete:
+            self.load()
+        return iter(list(self.fields))
+
+    def __len__(self):
+        self.accessed = True
+        if not self.complete:
+            self.load()
+        return len(self.fields)
+
+    # Forgets every field without reading them
+    def clear(self):
+        self.fields = {}
+        self.missing = set()
+        self.changed = set()
+        self.complete = True
+        self.cleared = True
+        self.modified = True
+
+    # Checks if the session was last renewed long enough ago to be renewed again
+    def needs_renewal(self):
+        return self.expires is not None and self.expires - time.time() < SESSION_LIFETIME - SESSION_RENEW_AFTER
+
+
+# Stores sessions in the database, where background workers and every web process can reach them
+class DatabaseSessionInterface(SessionInterface):
+    def open_session(self, app, request):
+        session_id = request.cookies.get(self.get_cookie_name(app))
+        return ServerSession(session_id if session_id and SESSION_ID.fullmatch(session_id) else None)
+
+    def save_session(self, app, session, response):
+        name, domain, path = self.get_cookie_name(app), self.get_cookie_domain(app), self.get_cookie_path(app)
+        if session.accessed:
+            response.vary.add('Cookie')
+
+        if not session.modified and not session.needs_renewal():
+            return
+
+        with db_transaction() as connection:
+            # Drops the old session when it was cleared, so a new login never reuses its id
+            if session.cleared and session.session_id:
+                connection.execute("DELETE FROM sessions WHERE id=?;", (session.session_id,))
+                session.session_id = None
+
+            if session.session_id is None and not session.fields:
+                if session.cleared:
+                    response.delete_cookie(name, domain=domain, path=path, secure=self.get_cookie_secure(app), samesite=self.get_cookie_samesite(app), httponly=self.get_cookie_httponly(app))
+                return
+
+            if session.session_id is None:
+                session.session_id = secrets.token_urlsafe(32)
+            expires = int(time.time()) + SESSION_LIFETIME
+
+            connection.execute("INSERT INTO sessions (id, expires) VALUES (?,?) ON CONFLICT(id) DO UPDATE SET expires=excluded.expires;", (session.session_id, expires))
+            connection.executemany("INSERT OR REPLACE INTO session_fields (session_id, field, value) VALUES (?,?,?);", 
+                                   [(session.session_id, field, json.dumps(session.fields[field])) for field in session.changed if field in session.fields])
+            connection.executemany("DELETE FROM session_fields WHERE session_id=? AND field=?;", [(session.session_id, field) for field in session.changed if field not in session.fields])
+
+        response.set_cookie(name, session.session_id, expires=expires, httponly=self.get_cookie_httponly(app), domain=domain, path=path, 
+                            secure=self.get_cookie_secure(app), samesite=self.get_cookie_samesite(app))
+
+
+app.session_interface = DatabaseSessionInterface()
+
+
+# Deletes sessions that have expired, run by the scheduler
+def expire_sessions():
+    db.execute("DELETE FROM sessions WHERE expires <= ?;", int(time.time()))
+
+    return
 
 
 # Clears user session and removes cache file
@@ -110,314 +1003,1136 @@ def clear_session():
         pass
         
 
-# Creates a spotify object
+# Gets the user's pooled spotify object
 def create_sp():
-    # Tries to get token data. If it doesn't succeed, returns user back to index page
+    # Tries to get the user's spotify object. If it doesn't succeed, returns user back to index page
     try:
-        token_info = get_token()
-        sp = spotipy.Spotify(auth=token_info['access_token'])
+        sp = CLIENTS.get(session['user_id'])
     except:
         return redirect(url_for("login")) 
 
     return sp
 
 
+# Fetches every page of a paginated Spotify endpoint and yields the items of each page in order
+# The first page gives the total number of items, so the remaining pages are requested concurrently
+# If given, parse turns the items of each page into what is yielded as soon as the page arrives, so that waiting pages stay small
+def paginate(fetch, limit, parse=None):
+    def fetch_items(offset):
+        items = fetch(limit=limit, offset=offset)['items']
+        return parse(items) if parse else items
+
+    first_page = fetch(limit=limit, offset=0)
+    yield parse(first_page['items']) if parse else first_page['items']
+
+    # Requests the remaining offsets on the shared worker pool
+    futures = [FETCH_POOL.submit(fetch_items, offset) for offset in range(limit, first_page['total'], limit)]
+    del first_page
+
+    try:
+        for future in futures:
+            yield future.result()
+    finally:
+        # Stops any requests that are no longer needed if the caller quits early
+        for future in futures:
+            future.cancel()
+
+
 # Checks Spotify for any changes in user's playlists, updates database, and returns a list
+# Playlists whose snapshot id hasn't changed since the last sync are left alone
 def get_playlists():
     sp = create_sp() # Creates a new spotify object
 
-    batch = sp.current_user_playlists(limit=50, offset=0)['items']
-    batchIterator = 0
-
-    sp_playlists = [] # Spotify playlists
-    db_playlists = [] # Database playlists
-    playlists = [] # Updated playlist list
-
-    # Gets playlist ID's from Spotify
-    while batch:
-        # Creates a list of user-managed playlists from Spotify
+    # Gets user-managed playlists from Spotify
+    sp_playlists = {}
+    for batch in paginate(sp.current_user_playlists, 50):
         for playlist in batch:
             if playlist['owner']['id'] == session['username']:
-                sp_playlists.append(playlist['id'])
-
-        # Iterates through batches until there are none left
-        batchIterator += 1
-        batch = sp.current_user_playlists(limit=50, offset=batchIterator*50)['items']
+                sp_playlists[playlist['id']] = playlist
     
-    # Gets playlist ID's from Database
-    db_temp = db.execute("SELECT playlist_id FROM playlists WHERE user_id=?;", session['user_id'])
-    for playlist in db_temp:
-        db_playlists.append(playlist['playlist_id'])
-
-    # Compares the two lists of playlists by ID's
-    for playlist in db_playlists:
-        if playlist in sp_playlists:
-            playlists.append(playlist)
-            sp_playlists.remove(playlist)
-        else:
-            db.execute("DELETE FROM playlists WHERE playlist_id=?;", playlist)
-    
-    # Adds playlists from Spotify that were not originally in the Database
-    if len(sp_playlists) > 0:
-        # Loops through playlist ID's
-        for playlist in sp_playlists:
-            playlist_info = sp.playlist(playlist) # Gets information about playlist from spotify
-            db.execute("INSERT INTO playlists VALUES (?,?,?,?,?)", session['user_id'], playlist_info['id'], playlist_info['name'], playlist_info['external_urls']['spotify'], 0) # Inserts playlist into database
-
-    playlists = db.execute("SELECT * FROM playlists WHERE user_id=?;", session['user_id']) # Gets updated list of playlists from database
+    # Gets playlists from Database
+    db_playlists = {playlist['playlist_id']: playlist for playlist in db.execute("SELECT * FROM playlists WHERE user_id=?;", session['user_id'])}
+
+    # Compares the two sets of playlists by ID's
+    deleted = [(playlist_id,) for playlist_id in db_playlists.keys() - sp_playlists.keys()]
+    added = [(session['user_id'], playlist_id, sp_playlists[playlist_id]['name'], sp_playlists[playlist_id]['external_urls']['spotify'], 0, sp_playlists[playlist_id]['snapshot_id']) 
+             for playlist_id in sp_playlists.keys() - db_playlists.keys()]
+    changed = [(sp_playlists[playlist_id]['name'], sp_playlists[playlist_id]['external_urls']['spotify'], sp_playlists[playlist_id]['snapshot_id'], playlist_id) 
+               for playlist_id in sp_playlists.keys() & db_playlists.keys() if sp_playlists[playlist_id]['snapshot_id'] != db_playlists[playlist_id]['snapshot_id']]
+
+    # Writes every change in one transaction, the worker managing a deleted smart playlist stops at its next heartbeat
+    if deleted or added or changed:
+        with db_transaction() as connection:
+            connection.executemany("DELETE FROM playlist_leases WHERE playlist_id=?;", deleted)
+            connection.executemany("DELETE FROM playlist_options WHERE playlist_id=?;", deleted)
+            connection.executemany("DELETE FROM playlist_tracks WHERE playlist_id=?;", deleted)
+            connection.executemany("DELETE FROM playlists WHERE playlist_id=?;", deleted)
+            connection.executemany("INSERT INTO playlists (user_id, playlist_id, playlist_name, playlist_link, is_smart, snapshot_id) VALUES (?,?,?,?,?,?);", added)
+            connection.executemany("UPDATE playlists SET playlist_name=?, playlist_link=?, snapshot_id=? WHERE playlist_id=?;", changed)
+
+    # Builds the updated list of playlists in the order they appear on Spotify
+    playlists = []
+    for playlist_id, playlist in sp_playlists.items():
+        playlists.append({'user_id': session['user_id'], 'playlist_id': playlist_id, 'playlist_name': playlist['name'], 'playlist_link': playlist['external_urls']['spotify'], 
+                          'is_smart': db_playlists[playlist_id]['is_smart'] if playlist_id in db_playlists else 0, 'snapshot_id': playlist['snapshot_id']})
+
     return playlists
 
 
-# Gets the tracks off of a given playlist and returns them
+# The parts of a Spotify track the app uses, kept without a dict per object so that large libraries stay small in memory
+class Track:
+    __slots__ = ('id', 'name', 'album', 'artists')
+
+    def __init__(self, id, name, album, artists):
+        self.id = id
+        self.name = name
+        self.album = album
+        self.artists = artists # Tuple of artist names
+
+    # Makes a track from an item of a playlist or of the liked songs, or returns None for removed and local tracks
+    @classmethod
+    def from_item(cls, item):
+        track = item['track']
+        if not track or not track['id']:
+            return None
+        return cls(track['id'], track['name'], track['album']['name'], tuple(artist['name'] for artist in track['artists']))
+
+    # Returns the track in the format sent to pages
+    def to_dict(self):
+        return {'id': self.id, 'name': self.name, 'album': self.album, 'artists': list(self.artists)}
+
+
+# Gets the tracks off of a given playlist and returns them as Track objects, skipping removed and local tracks
+# Each page is reduced to Track objects as it arrives, so the full Spotify objects of a large library are never all in memory
 def get_tracks(playlist_source):
     sp = create_sp() # Creates a new spotify object
     tracks = []
-    batchIterator = 0
 
+    # Reduces each page to Track objects on the thread that fetched it
+    def parse(items):
+        return [track for track in map(Track.from_item, items) if track]
+
+    # Liked songs are read from their copy in the database once it is up to date
     if playlist_source == 'liked songs':
-        # Gets all of the user's liked tracks
-        batch = sp.current_user_saved_tracks(limit=50, offset=0)['items']
+        sync_liked_songs(sp, session['user_id'])
+        return get_liked_songs(session['user_id'])
+
+    for batch in paginate(partial(sp.playlist_items, playlist_source, fields=f"items({TRACK_FIELDS}),total", additional_types=("track",)), 100, parse):
+        tracks.extend(batch)
+
+    return tracks
+
+
+# Returns the liked songs stored for a user as Track objects, newest first
+def get_liked_songs(user_id):
+    return [Track(row['track_id'], row['name'], row['album'], tuple(json.loads(row['artists']))) 
+            for row in db.execute("SELECT track_id, name, album, artists FROM liked_songs WHERE user_id=? ORDER BY added_at DESC;", user_id)]
+
+
+# Turns a page of liked songs into rows of the liked_songs table
+def liked_song_rows(user_id, items):
+    rows = []
+    for item in items:
+        track = Track.from_item(item)
+        if track:
+            rows.append((user_id, track.id, item['added_at'], track.name, track.album, json.dumps(track.artists)))
+
+    return rows
+
+
+# Brings the stored copy of a user's liked songs up to date
+# Spotify lists liked songs newest first, so pages are only fetched until one holds a song that is already stored with the same date,
+# and the whole library is fetched again once a day to remove the songs the user unliked
+def sync_liked_songs(sp, user_id, full=False):
+    state = db.execute("SELECT reconciled FROM liked_songs_syncs WHERE user_id=?;", user_id)
+    now = int(time.time())
+
+    if full or not state or state[0]['reconciled'] < now - LIKED_SONGS_RECONCILE:
+        rows = []
+        for batch in paginate(sp.current_user_saved_tracks, LIKED_SONGS_PAGE, partial(liked_song_rows, user_id)):
+            rows.extend(batch)
+
+        with db_transaction() as connection:
+            connection.execute("DELETE FROM liked_songs WHERE user_id=?;", (user_id,))
+            insert_many("INSERT OR REPLACE INTO liked_songs (user_id, track_id, added_at, name, album, artists)", rows, connection)
+            connection.execute("INSERT OR REPLACE INTO liked_songs_syncs (user_id, synced, reconciled) VALUES (?,?,?);", (user_id, now, now))
+
+        return
+
+    rows = []
+    offset = 0
+    while True:
+        page = sp.current_user_saved_tracks(limit=LIKED_SONGS_PAGE, offset=offset)
+        page_rows = liked_song_rows(user_id, page['items'])
+
+        # Stops at the first song that was already stored when it was liked, as every song after it is stored too
+        stored = {(row['track_id'], row['added_at']) for row in db.execute("SELECT track_id, added_at FROM liked_songs WHERE user_id=? AND track_id IN (?);", 
+                                                                             user_id, [row[1] for row in page_rows])} if page_rows else set()
+        new_rows = list(itertools.takewhile(lambda row: (row[1], row[2]) not in stored, page_rows))
+        rows.extend(new_rows)
 
-        while batch:
-            for track in batch:
-                tracks.append(track)
+        if len(new_rows) < len(page_rows) or not page['next']:
+            break
+        offset += LIKED_SONGS_PAGE
 
-            batchIterator += 1
-            batch = sp.current_user_saved_tracks(limit=50, offset=batchIterator*50)['items']
+    # Songs liked again replace their old entry, which has an older date
+    with db_transaction() as connection:
+        insert_many("INSERT OR REPLACE INTO liked_songs (user_id, track_id, added_at, name, album, artists)", rows, connection)
+        connection.execute("UPDATE liked_songs_syncs SET synced=? WHERE user_id=?;", (now, user_id))
 
+    return
+
+
+# Inserts a list of rows into the database in one transaction
+def insert_many(statement, rows, connection=None):
+    if not rows:
+        return
+
+    statement += " VALUES (" + ",".join(["?"] * len(rows[0])) + ");"
+
+    if connection:
+        connection.executemany(statement, rows)
     else:
-        batch = sp.playlist_tracks(playlist_source, limit=100, offset=0)['items']
+        with db_transaction() as connection:
+            connection.executemany(statement, rows)
 
-        while batch:
-            for track in batch:
-                tracks.append(track)
+    return
 
-            batchIterator += 1
-            batch = sp.playlist_tracks(playlist_source, limit=100, offset=batchIterator*100)['items']
 
-    return tracks
+# Returns a dict of audio features for each track id, only asking Spotify about tracks that are not cached yet
+# Pass sp when there is no session to take the user's spotify object from
+def get_audio_features(track_ids, sp=None):
+    track_ids = list(dict.fromkeys(track_id for track_id in track_ids if track_id)) # Removes duplicates and local tracks
+    features = {}
+
+    # Gets cached features from the database
+    for i in range(0, len(track_ids), 500):
+        for row in db.execute("SELECT * FROM audio_features WHERE track_id IN (?);", track_ids[i:i + 500]):
+            features[row['track_id']] = row
+
+    # Leaves out the tracks Spotify recently couldn't analyze
+    missing = [track_id for track_id in track_ids if track_id not in features]
+    unanalyzable = set()
+    for i in range(0, len(missing), 500):
+        unanalyzable.update(row['track_id'] for row in db.execute("SELECT track_id FROM audio_features_missing WHERE track_id IN (?) AND checked>?;", 
+                                                                  missing[i:i + 500], int(time.time()) - MISSING_FEATURES_RETRY))
+    missing = [track_id for track_id in missing if track_id not in unanalyzable]
+
+    # Fetches the missing features from Spotify in batches of 100
+    if missing:
+        sp = sp or create_sp()
+        batches = [missing[i:i + AUDIO_FEATURES_BATCH] for i in range(0, len(missing), AUDIO_FEATURES_BATCH)]
+
+        rows = []
+        misses = []
+        for batch, batch_features in zip(batches, FETCH_POOL.map(sp.audio_features, batches)):
+            # Spotify returns None for tracks it can't analyze, in the place of the track
+            for track_id, track_features in zip(batch, batch_features):
+                if track_features:
+                    features[track_features['id']] = track_features
+                    rows.append(tuple([track_features['id']] + [track_features[feature] for feature in AUDIO_FEATURES]))
+                else:
+                    misses.append((track_id, int(time.time())))
+
+        # Caches the new features for every user, and the tracks that have none
+        with db_transaction() as connection:
+            insert_many("INSERT OR REPLACE INTO audio_features (track_id, " + ", ".join(AUDIO_FEATURES) + ")", rows, connection)
+            insert_many("INSERT OR REPLACE INTO audio_features_missing (track_id, checked)", misses, connection)
+        FEATURE_INDEX.add(rows)
+
+    return features
+
+
+# Finds tracks with similar audio features among every track the app has analyzed, without asking Spotify
+# Features are kept feature by feature in contiguous rows, so that filters compare one row and distances take one matrix-vector product
+class FeatureIndex:
+    def __init__(self):
+        self.ids = [] # Column -> track id
+        self.columns = {} # Track id -> column
+        self.size = 0
+        self.lock = threading.Lock()
+        self.load_lock = threading.Lock() # Held while the stored tracks are read, so that nothing searches a half loaded index
+        self.loaded = False
+
+        # Scaled features go from 0 to 1 and are weighted, features with no weight are only used by the filters
+        ranges = [FEATURE_RANGES.get(feature, (0, 1)) for feature in AUDIO_FEATURES]
+        self.offsets = np.array([low for low, high in ranges], dtype=np.float32)
+        self.scales = np.array([FEATURE_WEIGHTS.get(feature, 1) / (high - low) for feature, (low, high) in zip(AUDIO_FEATURES, ranges)], dtype=np.float32)
+        self.weighted = np.flatnonzero(self.scales)
+
+        self.features = np.zeros((len(AUDIO_FEATURES), 0), dtype=np.float32) # Raw features, one row per feature
+        self.scaled = np.zeros((len(self.weighted) + 1, 0), dtype=np.float32) # Scaled features followed by the squared length of each column
+
+    # Reads every stored track the first time the index is used
+    def load(self):
+        if self.loaded:
+            return
+
+        with self.load_lock:
+            if self.loaded:
+                return
+
+            with db_transaction() as connection:
+                rows = connection.execute("SELECT track_id, " + ", ".join(AUDIO_FEATURES) + " FROM audio_features;").fetchall()
+            self.add(rows)
+            self.loaded = True
+
+    # Adds or updates tracks from rows of (track id, feature values in the order of AUDIO_FEATURES)
+    def add(self, rows):
+        if not rows:
+            return
+
+        with self.lock:
+            for row in rows:
+                if row[0] not in self.columns:
+                    self.columns[row[0]] = len(self.ids)
+                    self.ids.append(row[0])
+
+            # Grows the matrices by at least half so that adding tracks one batch at a time stays cheap
+            if len(self.ids) > self.features.shape[1]:
+                capacity = max(len(self.ids), self.features.shape[1] * 3 // 2, 1024)
+                for name in ('features', 'scaled'):
+                    old = getattr(self, name)
+                    grown = np.zeros((old.shape[0], capacity), dtype=np.float32)
+                    grown[:, :self.size] = old[:, :self.size]
+                    setattr(self, name, grown)
+
+            columns = np.array([self.columns[row[0]] for row in rows])
+            values = np.array([row[1:] for row in rows], dtype=np.float32)
+            scaled = ((values - self.offsets) * self.scales)[:, self.weighted]
+            self.features[:, columns] = values.T
+            self.scaled[:-1, columns] = scaled.T
+            self.scaled[-1, columns] = (scaled * scaled).sum(axis=1)
+            self.size = len(self.ids)
+
+    # Returns the raw features of a track, or None if it isn't in the index
+    def vector(self, track_id):
+        self.load()
+        with self.lock:
+            column = self.columns.get(track_id)
+            return None if column is None else self.features[:, column].copy()
+
+    # Returns the ids of the k tracks closest to a vector of raw features, closest first
+    # Tracks can be restricted to a list of keys, a mode and a (min, max) tempo whose bounds can be None, and excluded by id
+    def nearest(self, target, k, exclude=(), keys=None, mode=None, tempo=None):
+        self.load()
+        with self.lock:
+            size = self.size
+            features, scaled, ids = self.features[:, :size], self.scaled[:, :size], self.ids
+
+        # Narrows the search down to the tracks that pass the filters
+        mask = None
+        if keys is not None:
+            row = features[AUDIO_FEATURES.index('key')]
+            mask = np.zeros(size, dtype=bool)
+            for key in keys:
+                mask |= row == key
+        if mode is not None:
+            mask = (features[AUDIO_FEATURES.index('mode')] == mode) & (True if mask is None else mask)
+        if tempo is not None:
+            row = features[AUDIO_FEATURES.index('tempo')]
+            low, high = (-np.inf if tempo[0] is None else tempo[0]), (np.inf if tempo[1] is None else tempo[1])
+            mask = (row >= low) & (row <= high) & (True if mask is None else mask)
+
+        # Squared distances without the target's own length, which is the same for every track: |x|^2 - 2 x.q
+        query = np.append(-2 * ((np.asarray(target, dtype=np.float32) - self.offsets) * self.scales)[self.weighted], 1).astype(np.float32)
+        distances = query @ scaled
+
+        columns = None if mask is None else np.flatnonzero(mask)
+        if columns is not None:
+            distances = distances[columns]
+
+        # Takes enough of the closest tracks to still have k once excluded ones are dropped, and only sorts those
+        count = min(k + len(exclude), len(distances))
+        if count <= 0:
+            return []
+        closest = np.argpartition(distances, count - 1)[:count]
+        closest = closest[np.argsort(distances[closest])]
+        if columns is not None:
+            closest = columns[closest]
+
+        return [track_id for track_id in (ids[column] for column in closest.tolist()) if track_id not in exclude][:k]
+
+
+FEATURE_INDEX = FeatureIndex()
+
+
+# Returns the ids of the tracks the app knows that sound closest to a seed track, or none if the seed hasn't been analyzed
+# Takes the key, mode and tempo filters of a playlist as made by feature_filters
+def similar_tracks(seed_track, k, exclude=(), filters=None):
+    target = FEATURE_INDEX.vector(seed_track)
+    if target is None:
+        return []
+
+    return FEATURE_INDEX.nearest(target, k, exclude=set(exclude) | {seed_track}, **(filters or {}))
+
+
+# Returns the filters for FeatureIndex.nearest that a playlist's options set, leaving out the ones they don't
+def feature_filters(playlist_options):
+    return {name: playlist_options[name] for name in ('keys', 'mode', 'tempo') if playlist_options.get(name) is not None}
+
+
+# Returns the playlist id of a source url, or the source itself if it is already an id
+def parse_source(source_url):
+    if source_url == 'liked songs' or len(source_url) == 22:
+        return source_url
+    return source_url[34:56]
+
+
+# Returns the stored audio features of each track that has them, in the order of AUDIO_FEATURES
+def stored_features(track_ids, connection):
+    track_ids = list(track_ids)
+    features = {}
+    for i in range(0, len(track_ids), 500):
+        batch = track_ids[i:i + 500]
+        for track_id, *values in connection.execute("SELECT track_id, " + ", ".join(AUDIO_FEATURES) + " FROM audio_features WHERE track_id IN (" + ",".join(["?"] * len(batch)) + ");", batch):
+            features[track_id] = values
+
+    return features
+
+
+# Returns the running feature sums and track counts of a user's listening profile
+def load_profile(user_id, connection=None):
+    if connection:
+        rows = [{'sums': sums, 'counts': counts} for sums, counts in connection.execute("SELECT sums, counts FROM user_profiles WHERE user_id=?;", (user_id,))]
+    else:
+        rows = db.execute("SELECT sums, counts FROM user_profiles WHERE user_id=?;", user_id)
+    if not rows:
+        return np.zeros(len(AUDIO_FEATURES)), np.zeros(len(AUDIO_FEATURES))
+
+    return np.frombuffer(rows[0]['sums']).copy(), np.frombuffer(rows[0]['counts']).copy()
+
+
+# Adds, refreshes or removes (with an empty track list) a source of a user's listening profile
+# Only tracks entering or leaving the user's combined set of sources change the profile, so each track counts once
+# Tracks are counted once they have features, which may be on a later refresh, and only counted tracks are ever subtracted
+def update_profile_source(user_id, source_id, track_ids):
+    new_tracks = set(filter(None, track_ids))
+
+    # Analyzes the new tracks first, so that Spotify isn't waited on while the profile is locked
+    get_audio_features(new_tracks)
+
+    # Reads and writes the profile in one transaction, so that concurrent updates of the same user can't lose or repeat a change
+    with db_transaction() as connection:
+        connection.execute("BEGIN IMMEDIATE;")
+        old_tracks = {row[0] for row in connection.execute("SELECT track_id FROM profile_sources WHERE user_id=? AND source_id=?;", (user_id, source_id))}
+        other_tracks = {row[0] for row in connection.execute("SELECT DISTINCT track_id FROM profile_sources WHERE user_id=? AND source_id!=?;", (user_id, source_id))}
+
+        # Works out which of the tracks this source touches should be counted, and which already are
+        affected = list(old_tracks | new_tracks)
+        features = stored_features(affected, connection)
+        counted = set()
+        for i in range(0, len(affected), 500):
+            batch = affected[i:i + 500]
+            counted.update(row[0] for row in connection.execute("SELECT track_id FROM profile_tracks WHERE user_id=? AND track_id IN (" + ",".join(["?"] * len(batch)) + ");", 
+                                                                [user_id] + batch))
+        kept = {track_id for track_id in features if track_id in new_tracks or track_id in other_tracks}
+        added = kept - counted
+        removed = {track_id for track_id in counted - kept if track_id in features}
+
+        # Applies the difference to the running sums and counts
+        sums, counts = load_profile(user_id, connection)
+        sums += np.array([features[track_id] for track_id in added], dtype=np.float64).reshape(-1, len(AUDIO_FEATURES)).sum(axis=0)
+        sums -= np.array([features[track_id] for track_id in removed], dtype=np.float64).reshape(-1, len(AUDIO_FEATURES)).sum(axis=0)
+        counts += len(added) - len(removed)
+
+        # Stores the new source membership, counted tracks and profile
+        connection.executemany("DELETE FROM profile_tracks WHERE user_id=? AND track_id=?;", [(user_id, track_id) for track_id in removed])
+        insert_many("INSERT INTO profile_tracks (user_id, track_id)", [(user_id, track_id) for track_id in added], connection)
+        connection.executemany("DELETE FROM profile_sources WHERE user_id=? AND source_id=? AND track_id=?;", [(user_id, source_id, track_id) for track_id in old_tracks - new_tracks])
+        insert_many("INSERT INTO profile_sources (user_id, source_id, track_id)", [(user_id, source_id, track_id) for track_id in new_tracks - old_tracks], connection)
+        connection.execute("INSERT OR REPLACE INTO user_profiles (user_id, sums, counts) VALUES (?,?,?);", (user_id, sums.tobytes(), counts.tobytes()))
+
+    return
+
+
+# Returns the average value of each feature over every unique track in a user's sources, in the order of AUDIO_FEATURES
+def profile_vector(user_id):
+    sums, counts = load_profile(user_id)
+    return np.divide(sums, counts, out=np.zeros_like(sums), where=counts > 0)
 
 
-# Returns user's general preferences for a set of playlists
-# TODO Get user's favorite artists and tracks
-def get_user_data(source_url = False):
-    if source_url != False:
-        sp = create_sp() # Creates a new spotify object
-
-        # An empty dict to store user's listening tendencies
-        user_data = {
-            "audio_features": {
-                "mode": 0,
-                "key": 0,
-                "valence": 0,
-                "speechiness": 0,
-                "instrumentalness": 0,
-                "loudness": 0,
-                "energy": 0,
-                "danceability": 0,
-                "acousticness": 0,
-                "liveness": 0,
-                "tempo": 0
-            },
-            "favorite": {
-                "artist": "",
-                "track": "",
-                "genre": ""
-            }
-        } 
-        tracks = []
-
-        # Parses playlist url and gets tracks off the playlist
-        if len(source_url) != 22:
-            playlist_id = source_url[34:56]
+# Returns the average value of each feature over every unique track in a user's sources
+def get_profile(user_id):
+    averages = profile_vector(user_id)
+
+    profile = {}
+    for feature, average in zip(AUDIO_FEATURES, averages.tolist()):
+        if feature == 'tempo' or feature == 'key' or feature == 'loudness':
+            profile[feature] = round(average, 0)
         else:
-            playlist_id = source_url
-        tracks.extend(get_tracks(playlist_id))
-
-        # Packages the track ids
-        batch = []
-        for track in tracks:
-            if track['track']['id'] != None:
-                batch.append(track['track']['id'])
-
-        # Analyzes audio features of tracks
-        # TODO Add batches
-        playlist_size = 0
-        total_track_features = sp.audio_features(tracks=batch)
-
-        for features in total_track_features:
-            for feature in features:
-                try:
-                    user_data['audio_features'][feature] += features[feature] # Adds up all values for each feature
-                except:
-                    pass
-            playlist_size += 1
-        
-        # Calculates the average value for each feature
-        for feature in user_data['audio_features']:
-            user_data['audio_features'][feature] /= playlist_size
-            if feature == 'tempo' or feature == 'key' or feature == 'loudness':
-                user_data['audio_features'][feature] = round(user_data['audio_features'][feature], 0)
-            else:
-                user_data['audio_features'][feature] = round(user_data['audio_features'][feature], 3)
+            profile[feature] = round(average, 3)
 
-        return user_data
-    return source_url
+    return profile
 
 
-# Gets additional songs from Spotify
-def seed_more_tracks(limit, artists, genres, total_tracks):
-    sp = create_sp()
-    playlist_options = session['playlist_options']
-    results = []
-    tracks = [] # Clears the seeds  
-
-    # Randomly chooses tracks to seed (Makes sure there are 5 total seed sources)
-    if len(total_tracks) >= (5 - len(genres)):
-        for i in range(5 - (len(genres + artists))):
-            tracks.extend(sample(total_tracks, 1))
-
-    # Sets value to None if the list is empty
-    if artists == [] or artists == ['']:
-        artists = None
-    elif genres == [] or genres == ['']:
-        genres = None
-    elif tracks == set():
-        tracks = None 
-    
-    # Chooses a random key to seed
-    if playlist_options['key'] == [] or playlist_options['key'] == ['']:
-        key = None
-    else:
-        key = playlist_options['key'][randrange(len(playlist_options['key']))]
-
-    # Makes sure app makes a valid request to Spotify
-    if artists == None and genres == None and tracks == None:
-        print('error')
-        return error("No seeds")
-
-    # Fetches tracks from Spotify's recommendation system that match user parameters
-    batch = sp.recommendations(seed_artists=None, seed_genres=None, seed_tracks=[playlist_options['seed_track']], limit=limit, country=None, 
-        target_key=key, 
-        min_mode=mode[0], max_mode=mode[1])['tracks'] 
-    """target_valence=playlist_options['valence'], min_valence=get_bound('valence', changes['valence'])['min'], max_valence=get_bound('valence', changes['valence'])['max'], 
-    target_speechiness=playlist_options['speechiness'], min_speechiness=get_bound('speechiness', changes['speechiness'])['min'], max_speechiness=get_bound('speechiness', changes['speechiness'])['max'], 
-    target_instrumentalness=playlist_options['instrumentalness'], min_instrumentalness=get_bound('instrumentalness', changes['instrumentalness'])['min'], max_instrumentalness=get_bound('instrumentalness', changes['instrumentalness'])['max'], 
-    target_loudness=playlist_options['loudness'], min_loudness=get_bound('loudness', changes['loudness'])['min'], max_loudness=get_bound('loudness', changes['loudness'])['max'], 
-    target_energy=playlist_options['energy'], min_energy=get_bound('energy', changes['energy'])['min'], max_energy=get_bound('energy', changes['energy'])['max'], 
-    target_danceability=playlist_options['danceability'], min_danceability=get_bound('danceability', changes['danceability'])['min'], max_danceability=get_bound('danceability', changes['danceability'])['max'], 
-    target_acousticness=playlist_options['acousticness'], min_acousticness=get_bound('acousticness', changes['acousticness'])['min'], max_acousticness=get_bound('acousticness', changes['acousticness'])['max'], 
-    target_liveness=playlist_options['liveness'], min_liveness=get_bound('liveness', changes['liveness'])['min'], max_liveness=get_bound('liveness', changes['liveness'])['max'], 
-    target_tempo=playlist_options['tempo'], min_tempo=get_bound('tempo', changes['tempo'])['min'], max_tempo=get_bound('tempo', changes['tempo'])['max'])['tracks']"""
-
-    for track in batch:
-        results.append(track['id'])
-    
-    return results
+# Returns the sources currently used for a user's listening profile
+def get_profile_sources(user_id):
+    return [row['source_id'] for row in db.execute("SELECT DISTINCT source_id FROM profile_sources WHERE user_id=?;", user_id)]
 
 
-# TODO Stores options for smart playlist in database
-def store_options(playlist_id):
-    playlist_options = session['playlist_options']
+# Stores the current state of a user's listening profile in its history
+def record_profile_snapshot(user_id, num_sources):
+    sums, counts = load_profile(user_id)
+    averages = np.divide(sums, counts, out=np.zeros_like(sums), where=counts > 0)
 
-    db.execute("INSERT INTO playlist_options VALUES (?,?,?,?,?)", session['user_id'], playlist_id, playlist_options)
+    db.execute("INSERT OR REPLACE INTO profile_history (user_id, timestamp, features, num_tracks, num_sources) VALUES (?,?,?,?,?);", 
+               user_id, int(time.time()), averages.astype(np.float32).tobytes(), int(counts.max(initial=0)), num_sources)
 
     return
 
 
-# Tracks user playback and logs track skips
-def log_playback(user_id):
-    sp = create_sp()
-    past_track_id = None
+# Returns the timestamps and feature vectors of a user's profile snapshots between two times, and how many snapshots each stands for
+# With a bucket ('day' or 'week'), snapshots are averaged per bucket and stamped with the bucket's start
+def get_profile_history(user_id, start, end, bucket=None):
+    with db_transaction() as connection:
+        rows = connection.execute("SELECT timestamp, features FROM profile_history WHERE user_id=? AND timestamp BETWEEN ? AND ? ORDER BY timestamp;", 
+                                  (user_id, start, end)).fetchall()
 
-    while True:
-        # TODO change current_playback()
-        current_track_id = sp.current_playback()
-        track_position = sp.current_playback()
+    timestamps = np.array([row[0] for row in rows], dtype=np.int64)
+    vectors = np.frombuffer(b"".join(row[1] for row in rows), dtype=np.float32).reshape(-1, len(AUDIO_FEATURES))
+    counts = np.ones(len(rows), dtype=np.int64)
+
+    if bucket and len(rows):
+        size, offset = HISTORY_BUCKETS[bucket]
+        groups = (timestamps + offset) // size
+        firsts = np.flatnonzero(np.diff(groups, prepend=groups[0] - 1)) # Index of the first snapshot of each bucket, as snapshots are sorted
+        counts = np.diff(np.append(firsts, len(rows)))
+        vectors = np.add.reduceat(vectors, firsts, axis=0) / counts[:, None]
+        timestamps = groups[firsts] * size - offset
+
+    return timestamps, vectors, counts
+
+
+# Returns the ids of tracks Spotify recommends for a set of seed tracks, reusing earlier responses for the same seeds
+def get_recommendations(sp, seed_tracks, limit=RECOMMENDATION_LIMIT):
+    key = (tuple(seed_tracks), limit)
+
+    with RECOMMENDATION_CACHE_LOCK:
+        if key in RECOMMENDATION_CACHE:
+            RECOMMENDATION_CACHE.move_to_end(key)
+            return RECOMMENDATION_CACHE[key]
+
+    track_ids = [track['id'] for track in sp.recommendations(seed_tracks=list(seed_tracks), limit=limit)['tracks']]
+
+    with RECOMMENDATION_CACHE_LOCK:
+        RECOMMENDATION_CACHE[key] = track_ids
+        if len(RECOMMENDATION_CACHE) > RECOMMENDATION_CACHE_SIZE:
+            RECOMMENDATION_CACHE.popitem(last=False)
+
+    return track_ids
 
-        if current_track_id != past_track_id:
-            if track_position < track_duration / 2:
-                db.execute("UPDATE") # TODO Add a skip to the track
 
-            track_duration = sp.current_playback()
+# Gathers a given number of unique recommended tracks around a seed track
+# Part of them are the known tracks that sound closest to the seed, and the rest come from Spotify's recommendations
+# Requests are sent concurrently, and every new track becomes a seed (paired with the original seed) for later requests
+# If given, progress is called with the number of tracks found after every response
+def build_candidate_pool(sp, seed_track, size, exclude=(), progress=None, filters=None):
+    found = set(exclude)
+    seeds = [(seed_track,)]
+    used_seeds = set()
 
-        past_track_id = current_track_id
+    # Analyzes the seed first so that similar tracks can be found locally
+    get_audio_features([seed_track], sp)
+    candidates = similar_tracks(seed_track, int(size * LOCAL_CANDIDATE_SHARE), exclude=found, filters=filters) # Unique tracks in the order they were found
+    found.update(candidates)
 
-        time.sleep(2)
+    while len(candidates) < size and seeds:
+        # Sends the next round of requests
+        batch, seeds = seeds[:RECOMMENDATION_FANOUT], seeds[RECOMMENDATION_FANOUT:]
+        used_seeds.update(batch)
+        futures = [FETCH_POOL.submit(get_recommendations, sp, seed) for seed in batch]
+
+        # Collects new tracks as responses come in and stops as soon as there are enough
+        for future in as_completed(futures):
+            for track_id in future.result():
+                if track_id not in found:
+                    found.add(track_id)
+                    candidates.append(track_id)
+
+                    if (seed_track, track_id) not in used_seeds:
+                        seeds.append((seed_track, track_id))
+
+            if progress:
+                progress(min(len(candidates), size))
+
+            if len(candidates) >= size:
+                for pending in futures:
+                    pending.cancel()
+                break
+
+    # Fills whatever Spotify couldn't with more similar tracks
+    if len(candidates) < size:
+        candidates.extend(similar_tracks(seed_track, size - len(candidates), exclude=found, filters=filters))
+
+    return candidates[:size]
+
+
+# Stores options for smart playlist in database
+def store_options(user_id, playlist_id, playlist_options):
+    db.execute("INSERT INTO playlist_options (user_id, playlist_id, auto_add, replace, allow_explicit, options) VALUES (?,?,?,?,?,?);", user_id, playlist_id, 
+               str(playlist_options['auto_add']), str(playlist_options['auto_add'][1]), str(playlist_options['allow_explicit']), json.dumps(playlist_options))
+
+    return
+
+
+# Returns the part of a playback state that Spotify's currently-playing endpoint would return
+def currently_playing_from(playback):
+    if not playback:
+        return None
+
+    return {key: playback.get(key) for key in ['timestamp', 'context', 'progress_ms', 'item', 'currently_playing_type', 'actions', 'is_playing']}
+
+
+# Follows a user's playback and notices when a track is skipped
+class PlaybackLogger:
+    def __init__(self, user_id):
+        self.user_id = user_id
+        self.track_id = None
+        self.playlist_id = None
+        self.progress_ms = 0
+        self.duration_ms = 0
+
+    # Checks playback once and returns the number of seconds until the next check
+    def poll(self):
+        playback = CLIENTS.get(self.user_id).current_playback()
+
+        # Forgets the track without logging a skip when playback stopped or moved to something that isn't a track,
+        # since there's no way to tell whether the track was skipped or just left playing to the end
+        if not playback or not playback.get('item') or playback['item'].get('type', 'track') != 'track':
+            self.reset(None, None)
+            return PLAYBACK_POLL_IDLE
+
+        # Only tracks played from a playlist can be counted against that playlist
+        context = playback.get('context')
+        if context and context['type'] == 'playlist':
+            playlist_id = context['uri'].split(':')[-1]
+        else:
+            playlist_id = None
+
+        if playback['item']['id'] != self.track_id:
+            self.track_changed(playback['item']['id'], playlist_id)
+        self.progress_ms = playback['progress_ms'] or 0
+        self.duration_ms = playback['item']['duration_ms']
+
+        if not playback['is_playing']:
+            return PLAYBACK_POLL_IDLE
+
+        # Checks again right after the track passes the skip threshold, then right after it ends
+        threshold_ms = self.duration_ms * SKIP_THRESHOLD
+        if self.progress_ms < threshold_ms:
+            wait_ms = threshold_ms - self.progress_ms
+        else:
+            wait_ms = self.duration_ms - self.progress_ms
+        return min(max(wait_ms / 1000 + 1, PLAYBACK_POLL_MIN), PLAYBACK_POLL_MAX)
+
+    # Logs a skip if the previous track was left before reaching the skip threshold
+    def track_changed(self, track_id, playlist_id):
+        if self.track_id and self.playlist_id and self.progress_ms < self.duration_ms * SKIP_THRESHOLD:
+            with PENDING_SKIPS_LOCK:
+                PENDING_SKIPS[(self.playlist_id, self.track_id)] += 1
+
+        self.reset(track_id, playlist_id)
+
+    # Starts following a new track
+    def reset(self, track_id, playlist_id):
+        self.track_id = track_id
+        self.playlist_id = playlist_id
+        self.progress_ms = 0
+        self.duration_ms = 0
+
+
+PLAYBACK_LOGGERS = {} # User id -> playback logger
+PLAYBACK_LOGGERS_LOCK = threading.Lock()
+PENDING_SKIPS = Counter() # (playlist id, track id) -> skips not written to the database yet
+PENDING_SKIPS_LOCK = threading.Lock()
+
+
+# Tracks user playback and logs track skips, run by the scheduler at the interval the last check returned
+def log_playback(user_id):
+    with PLAYBACK_LOGGERS_LOCK:
+        if user_id not in PLAYBACK_LOGGERS:
+            PLAYBACK_LOGGERS[user_id] = PlaybackLogger(user_id)
+        logger = PLAYBACK_LOGGERS[user_id]
+
+    return logger.poll()
+
+
+# Adds every skip logged since the last flush to the playlist tracks in one transaction
+def flush_skips():
+    with PENDING_SKIPS_LOCK:
+        skips = [(count, playlist_id, track_id) for (playlist_id, track_id), count in PENDING_SKIPS.items()]
+        PENDING_SKIPS.clear()
+
+    if skips:
+        with db_transaction() as connection:
+            connection.executemany("UPDATE playlist_tracks SET num_skips = num_skips + ? WHERE playlist_id=? AND track_id=?;", skips)
 
     return
 
 
 # Stores tracks into the database to prevent copies
-def store_tracks(playlist_id, track_list):
-    for track in track_list:
-        db.execute("INSERT INTO playlist_tracks (user_id, playlist_id, track_id) VALUES (?,?,?)", session['user_id'], playlist_id, track)
+def store_tracks(user_id, playlist_id, track_list):
+    insert_many("INSERT OR IGNORE INTO playlist_tracks (user_id, playlist_id, track_id)", [(user_id, playlist_id, track) for track in track_list])
 
     return
 
 
-# Seeds a new track from a given track
-def seed_new_track(seed):
-    sp = create_sp()
+# Runs recurring jobs from a single time-ordered queue on a bounded pool of threads
+# A job can return a number of seconds to override its interval until the next run
+class Scheduler:
+    def __init__(self, workers):
+        self.queue = [] # Heap of (due time, sequence number, job id)
+        self.jobs = {} # Job id -> [function, args, interval, sequence number]
+        self.running = set() # Ids of jobs currently being run
+        self.sequence = itertools.count()
+        self.condition = threading.Condition()
+        self.pool = ThreadPoolExecutor(max_workers=workers)
+        self.thread = None
+
+    # Starts the thread that hands due jobs to the pool
+    def start(self):
+        with self.condition:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, daemon=True)
+                self.thread.start()
+
+    # Adds or replaces a job that runs every interval seconds, first running after delay seconds
+    def schedule(self, job_id, function, interval, *args, delay=None):
+        with self.condition:
+            sequence = next(self.sequence)
+            self.jobs[job_id] = [function, args, interval, sequence]
+            heapq.heappush(self.queue, (time.time() + (interval if delay is None else delay), sequence, job_id))
+            self.condition.notify()
+
+    # Changes how often a job runs, counting from now
+    def reschedule(self, job_id, interval):
+        with self.condition:
+            job = self.jobs.get(job_id)
+            if job:
+                self.schedule(job_id, job[0], interval, *job[1])
+
+    # Stops a job from running again (queue entries of cancelled jobs are skipped when they come up)
+    def cancel(self, job_id):
+        with self.condition:
+            self.jobs.pop(job_id, None)
+
+    # Waits for the next job to be due and hands it to the pool
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.queue or self.queue[0][0] > time.time():
+                    self.condition.wait(self.queue[0][0] - time.time() if self.queue else None)
+
+                due, sequence, job_id = heapq.heappop(self.queue)
+                job = self.jobs.get(job_id)
+
+                # Skips jobs that were cancelled or rescheduled since this entry was queued
+                if job is None or job[3] != sequence:
+                    continue
+
+                # Doesn't run the same job twice at once
+                if job_id in self.running:
+                    heapq.heappush(self.queue, (time.time() + 1, sequence, job_id))
+                    continue
+
+                self.running.add(job_id)
+
+            self.pool.submit(self.run_job, job_id, sequence, job[0], job[1], job[2])
+
+    # Runs a job and queues its next run if it hasn't been cancelled or rescheduled in the meantime
+    def run_job(self, job_id, sequence, function, args, interval):
+        METRIC_SOURCE.set(function.__name__)
+        SPOTIFY_PRIORITY.set(PRIORITY_BACKGROUND)
+        start = time.perf_counter()
+
+        try:
+            delay = function(*args)
+        except Exception as e:
+            print(f"Job {job_id} failed: {e!r}")
+            METRICS.increment("spotihelp_job_errors_total", {'job': function.__name__})
+            delay = None
+        METRICS.observe("spotihelp_job_seconds", {'job': function.__name__}, time.perf_counter() - start)
+
+        with self.condition:
+            self.running.discard(job_id)
+            job = self.jobs.get(job_id)
+            if job and job[3] == sequence:
+                heapq.heappush(self.queue, (time.time() + (interval if delay is None else delay), sequence, job_id))
+                self.condition.notify()
+
+
+SCHEDULER = Scheduler(SCHEDULER_WORKERS)
+
+
+# Queues recommended tracks for a smart playlist so that adding a track rarely needs a request to Spotify
+# Candidates are fetched a full batch at a time and refilled in the background when the queue runs low
+class CandidateBuffer:
+    def __init__(self, user_id, playlist_id, seed, filters=None):
+        self.user_id = user_id
+        self.playlist_id = playlist_id
+        self.seed = seed
+        self.filters = filters # Key, mode and tempo filters for the known tracks, from feature_filters
+        self.members = {row['track_id'] for row in db.execute("SELECT track_id FROM playlist_tracks WHERE playlist_id=?;", playlist_id)} # Tracks already in the playlist
+        self.queue = deque()
+        self.queued = set()
+        self.lock = threading.Lock()
+        self.refilling = None # Background refill in progress
+
+    # Queues the known tracks closest to the seed and a batch of recommendations, leaving out the ones already in the playlist
+    # Tracks already in the playlist are used as extra seeds so that each batch brings new tracks
+    def refill(self):
+        sp = CLIENTS.get(self.user_id)
+
+        with self.lock:
+            seeds = [self.seed] + sample(sorted(self.members - {self.seed}), min(2, len(self.members - {self.seed})))
+            known = self.members | self.queued
+
+        track_ids = similar_tracks(self.seed, int(RECOMMENDATION_LIMIT * LOCAL_CANDIDATE_SHARE), exclude=known, filters=self.filters)
+        track_ids += [track['id'] for track in sp.recommendations(seed_tracks=seeds, limit=RECOMMENDATION_LIMIT)['tracks']]
+
+        with self.lock:
+            for track_id in track_ids:
+                if track_id not in self.members and track_id not in self.queued:
+                    self.queue.append(track_id)
+                    self.queued.add(track_id)
+
+        return
+
+    # Starts a background refill unless one is already running
+    def refill_later(self):
+        with self.lock:
+            if self.refilling is None or self.refilling.done():
+                # Refills in the background lane, since nothing waits on them until the queue runs out
+                priority = SPOTIFY_PRIORITY.set(PRIORITY_BACKGROUND)
+                try:
+                    self.refilling = REFILL_POOL.submit(self.refill)
+                finally:
+                    SPOTIFY_PRIORITY.reset(priority)
+
+    # Returns the next track to add, or None if Spotify has nothing new
+    # The track stays first in line until added() confirms it made it into the playlist
+    def peek(self):
+        # Only waits on Spotify if the queue is empty, and then on the refill already running if there is one
+        if not self.queue:
+            with self.lock:
+                refilling = self.refilling if self.refilling is not None and not self.refilling.done() else None
+            if refilling is not None:
+                refilling.result()
+            else:
+                self.refill()
+
+        with self.lock:
+            while self.queue and self.queue[0] in self.members:
+                self.queued.discard(self.queue.popleft())
+            track_id = self.queue[0] if self.queue else None
+
+            running_low = len(self.queue) < CANDIDATE_LOW_WATER
+
+        if running_low:
+            self.refill_later()
+
+        return track_id
+
+    # Marks a track returned by peek() as part of the playlist
+    def added(self, track_id):
+        with self.lock:
+            self.members.add(track_id)
+            if self.queue and self.queue[0] == track_id:
+                self.queued.discard(self.queue.popleft())
+
+
+CANDIDATE_BUFFERS = {} # Playlist id -> candidate buffer
+CANDIDATE_BUFFERS_LOCK = threading.Lock()
+
 
-    track = sp.recommendations(
-            seed_artists=None, seed_genres=None, seed_tracks=[seed], limit=1)['tracks']
-    track_id = track[0]['id']
+# Returns the candidate buffer of a smart playlist, creating it the first time and again when its seed or filters change
+def get_candidate_buffer(user_id, playlist_id, seed, filters=None):
+    with CANDIDATE_BUFFERS_LOCK:
+        buffer = CANDIDATE_BUFFERS.get(playlist_id)
+        if buffer is None or buffer.seed != seed or buffer.filters != filters:
+            CANDIDATE_BUFFERS[playlist_id] = CandidateBuffer(user_id, playlist_id, seed, filters)
+        return CANDIDATE_BUFFERS[playlist_id]
 
-    return track_id
 
+# Adds a track to a user's smart playlist, run by the scheduler at the frequency the user chose
+def manage_playlist(user_id, playlist_id, seed, filters=None):
+    sp = CLIENTS.get(user_id)
 
-# Manages a user's playlist as a separate thread
-# TODO Exit the thread and close logger thread if the user deletes the playlist or turns off the smart playlist feature
-def manage_playlist(user_id, playlist_id, playlist_options, playlist_tracks, seed, session):
-    # TODO Starts a thread that logs user skips if the user selected the 'replace' option
+    # TODO check for user-set max skips
     """if playlist_options['replace']:
-        logger_thread = threading.Thread(
-            target=log_playback, args=[session['user_id']])
-        logger_thread.start()
-        THREADS[f"{session['username']}_{playlist_id}"].append(logger_thread)"""
+        candidates = db.execute(
+            "SELECT track_id, num_skips FROM playlist_tracks WHERE user_id=? AND is_hearted=? AND playlist_id=?", user_id, 0, playlist_id)"""
+        
+        # TODO Check database for most-skipped tracks and non-favorited tracks
+
+    # Leaves the playlist alone if this worker couldn't renew its lease, as another worker may have taken it
+    if time.time() > LEASES['expires']:
+        return
+
+    # Takes the next track that isn't in the playlist yet from the playlist's buffer, which keeps it for the next run if adding it fails
+    buffer = get_candidate_buffer(user_id, playlist_id, seed, filters)
+    track_id = buffer.peek()
+
+    if track_id:
+        sp.playlist_add_items(playlist_id, [track_id], position=None)
+        buffer.added(track_id)
+
+        db.execute("INSERT OR IGNORE INTO playlist_tracks (user_id, playlist_id, track_id) VALUES (?,?,?)",
+                user_id, playlist_id, track_id)
+
+    return
+
+
+# Starts managing a smart playlist in this worker
+def schedule_playlist(user_id, playlist_id, playlist_options):
+    SCHEDULER.schedule(playlist_id, manage_playlist, playlist_options['auto_add'][2], user_id, playlist_id, playlist_options['seed_track'], 
+                       feature_filters(playlist_options))
+
+    return
+
+
+# Stops managing a smart playlist in this worker
+def unschedule_playlist(playlist_id):
+    SCHEDULER.cancel(playlist_id)
+
+    with CANDIDATE_BUFFERS_LOCK:
+        CANDIDATE_BUFFERS.pop(playlist_id, None)
+
+    return
+
+
+MANAGED_PLAYLISTS = {} # Playlist id -> options of the smart playlists this worker manages
+LEASES = {'expires': 0} # Time until which this worker's leases are known to be valid
+MANAGED_OPTIONS = "options IS NOT NULL AND json_extract(options, '$.auto_add[0]')" # Smart playlists that add tracks automatically, the only ones a worker has to run
+
+
+# Renews this worker's leases and takes or gives up smart playlists so that every live worker manages its share, run by the scheduler
+# Playlists of a worker that stopped renewing are taken over once their leases expire
+def claim_playlists():
+    now = int(time.time())
+    expires = now + LEASE_DURATION
+
+    with db_transaction() as connection:
+        connection.execute("BEGIN IMMEDIATE;") # Stops two workers from taking the same playlist
+        connection.execute("INSERT OR REPLACE INTO workers (id, expires) VALUES (?,?);", (WORKER_ID, expires))
+        connection.execute("DELETE FROM workers WHERE expires<?;", (now,))
+        connection.execute("DELETE FROM playlist_leases WHERE expires<? OR playlist_id NOT IN (SELECT playlist_id FROM playlist_options WHERE " + MANAGED_OPTIONS + ");", (now,))
+        connection.execute("UPDATE playlist_leases SET expires=? WHERE owner=?;", (expires, WORKER_ID))
+
+        smart = connection.execute("SELECT user_id, playlist_id, options FROM playlist_options WHERE " + MANAGED_OPTIONS + " ORDER BY playlist_id;").fetchall()
+        leases = dict(connection.execute("SELECT playlist_id, owner FROM playlist_leases;").fetchall())
+        workers = connection.execute("SELECT COUNT(*) FROM workers;").fetchone()[0]
+        owned = sorted(playlist_id for playlist_id, owner in leases.items() if owner == WORKER_ID)
+        share = -(-len(smart) // workers)
+
+        # Gives up playlists above this worker's share, or takes free ones up to it
+        released = owned[share:]
+        claimed = [playlist_id for user_id, playlist_id, options in smart if playlist_id not in leases][:max(share - len(owned), 0)]
+        connection.executemany("DELETE FROM playlist_leases WHERE playlist_id=? AND owner=?;", [(playlist_id, WORKER_ID) for playlist_id in released])
+        insert_many("INSERT INTO playlist_leases (playlist_id, owner, expires)", [(playlist_id, WORKER_ID, expires) for playlist_id in claimed], connection)
+
+    LEASES['expires'] = expires
+    owned = set(owned[:share]) | set(claimed)
+
+    # Brings the scheduler in line with the leases
+    for playlist_id in set(MANAGED_PLAYLISTS) - owned:
+        unschedule_playlist(playlist_id)
+        del MANAGED_PLAYLISTS[playlist_id]
+    for user_id, playlist_id, options in smart:
+        if playlist_id in owned and MANAGED_PLAYLISTS.get(playlist_id) != options:
+            schedule_playlist(user_id, playlist_id, json.loads(options))
+            MANAGED_PLAYLISTS[playlist_id] = options
+
+    # Logs the skips of users who chose the 'replace' option, on the worker holding the first such playlist so that they are only logged once
+    loggers = {}
+    for user_id, playlist_id, options in smart:
+        if json.loads(options)['auto_add'][1]:
+            loggers.setdefault(user_id, playlist_id)
+    with PLAYBACK_LOGGERS_LOCK:
+        logged = set(PLAYBACK_LOGGERS)
+    for user_id in set(loggers) | logged:
+        if loggers.get(user_id) in owned:
+            if f"playback_{user_id}" not in SCHEDULER.jobs:
+                SCHEDULER.schedule(f"playback_{user_id}", log_playback, PLAYBACK_POLL_MAX, user_id, delay=0)
+        else:
+            SCHEDULER.cancel(f"playback_{user_id}")
+            with PLAYBACK_LOGGERS_LOCK:
+                PLAYBACK_LOGGERS.pop(user_id, None)
+
+    return
+
+
+# Hands this worker's playlists back so that other workers take them right away, run when the worker stops
+def release_playlists():
+    with db_transaction() as connection:
+        connection.execute("DELETE FROM playlist_leases WHERE owner=?;", (WORKER_ID,))
+        connection.execute("DELETE FROM workers WHERE id=?;", (WORKER_ID,))
+
+    LEASES['expires'] = 0
+    flush_skips()
+
+    return
+
+
+# Starts managing smart playlists in this process, run by worker.py
+def start_worker():
+    SCHEDULER.schedule('claim-playlists', claim_playlists, LEASE_HEARTBEAT, delay=0)
+    SCHEDULER.schedule('flush-skips', flush_skips, SKIP_FLUSH_INTERVAL)
+
+    return
 
-    # Loops with a user-set frequency and adds/replaces tracks according to that frequency
-    while True:
-        sp = create_sp()
-
-        # Waits the designated time interval specified
-        time.sleep(playlist_options['auto_add'][2])
-
-        # Seeds a new track to add to the playlist
-        track_id = seed_new_track(seed)
-
-        # Removes a track from the given playlist if the user set the option
-        # TODO check for user-set max skips
-        """if playlist_options['replace']:
-            candidates = db.execute(
-                "SELECT track_id, num_skips FROM playlist_tracks WHERE user_id=? AND is_hearted=? AND playlist_id=?", user_id, 0, playlist_id)"""
-            
-            # TODO Check database for most-skipped tracks and non-favorited tracks
-
-        # Checks to make sure that track has not been added before and seeds another one if it has been added
-        fail_count = 0
-        while fail_count < 50:
-            if track_id not in playlist_tracks:
-                sp.user_playlist_add_tracks(
-                    session['username'], playlist_id, [track_id], position=None)
-
-                playlist_tracks.add(track_id)
-                db.execute("INSERT INTO playlist_tracks (user_id, playlist_id, track_id) VALUES (?,?,?)",
-                        user_id, playlist_id, track_id)
-                break
-            else:
-                track_id = seed_new_track(seed)
-                fail_count += 1
 
+# Work started from a page that runs in the background, with progress events the page can follow
+class Job:
+    def __init__(self, job_id, user_id):
+        self.id = job_id
+        self.user_id = user_id
+        self.events = [] # (event name, data) in the order they happened
+        self.finished = None # Time the job ended
+        self.condition = threading.Condition()
+
+    # Adds a progress event and wakes everyone following the job
+    def report(self, event, **data):
+        with self.condition:
+            self.events.append((event, data))
+            if event == 'done' or event == 'failed':
+                self.finished = time.time()
+            self.condition.notify_all()
+
+    # Returns the events after the first seen ones, waiting up to timeout seconds for one if there are none yet
+    def wait(self, seen, timeout=None):
+        with self.condition:
+            if len(self.events) <= seen and self.finished is None:
+                self.condition.wait(timeout)
+            return self.events[seen:]
+
+
+# Runs jobs on a small pool of threads so that the requests starting them return right away
+class JobQueue:
+    def __init__(self, workers):
+        self.pool = ThreadPoolExecutor(max_workers=workers)
+        self.jobs = {} # Job id -> job
+        self.lock = threading.Lock()
+
+    # Queues function(job, *args) for a user and returns its job
+    def submit(self, user_id, function, *args):
+        job = Job(secrets.token_urlsafe(16), user_id)
+        with self.lock:
+            self.jobs[job.id] = job
+
+        job.report('queued')
+        self.pool.submit(self.run, job, function, args)
+
+        return job
+
+    # Runs a job, making sure it ends with either a 'done' or a 'failed' event
+    def run(self, job, function, args):
+        METRIC_SOURCE.set(function.__name__)
+        SPOTIFY_PRIORITY.set(PRIORITY_CREATION) # Lets page views go first
+        start = time.perf_counter()
+
+        try:
+            function(job, *args)
+            if job.finished is None:
+                job.report('done')
+        except Exception as e:
+            print(f"Job {job.id} failed: {e!r}")
+            METRICS.increment("spotihelp_job_errors_total", {'job': function.__name__})
+            job.report('failed', message="Something went wrong, please try again.")
+        METRICS.observe("spotihelp_job_seconds", {'job': function.__name__}, time.perf_counter() - start)
+
+    # Returns a job by its id, if it is still kept
+    def get(self, job_id):
+        with self.lock:
+            return self.jobs.get(job_id)
+
+    # Forgets jobs that finished a while ago, run by the scheduler
+    def expire(self):
+        with self.lock:
+            for job_id in [job_id for job_id, job in self.jobs.items() if job.finished and job.finished < time.time() - JOB_RETENTION]:
+                del self.jobs[job_id]
+
+
+JOBS = JobQueue(JOB_WORKERS)
+
+
+# Fills a new playlist with recommendations and stores it, reporting each step to the page that started it
+def create_playlist(job, user_id, username, playlist_options):
+    sp = CLIENTS.get(user_id)
+    size = playlist_options['size']
+
+    # Populates playlist with unique tracks
+    job.report('progress', stage="Finding tracks", done=0, total=size)
+    total_tracks_list = build_candidate_pool(sp, playlist_options['seed_track'], size, filters=feature_filters(playlist_options), 
+                                             progress=lambda found: job.report('progress', stage="Finding tracks", done=found, total=size))
+
+    # Creates a new empty playlist with user parameters
+    new_playlist = sp.user_playlist_create(username, playlist_options['name'], public=playlist_options['public'], description=playlist_options['description'])
+
+    # Adds tracks in batches of 100
+    for i in range(0, len(total_tracks_list), 100):
+        sp.user_playlist_add_tracks(username, new_playlist['id'], total_tracks_list[i:i + 100], position=None)
+        job.report('progress', stage="Adding tracks", done=min(i + 100, len(total_tracks_list)), total=len(total_tracks_list))
+
+    # Stores the playlist info into database
+    db.execute("INSERT INTO playlists (user_id, playlist_id, playlist_name, playlist_link, is_smart) VALUES (?,?,?,?,?);", user_id, new_playlist['id'], new_playlist['name'], new_playlist['href'], str(playlist_options['is_smart']))
+    if playlist_options['is_smart']:
+        store_options(user_id, new_playlist['id'], playlist_options)
+    store_tracks(user_id, new_playlist['id'], total_tracks_list)
+
+    job.report('done', name=new_playlist['name'], link=new_playlist['external_urls']['spotify'])
 
     return
 
+
+# Smart playlists are managed by worker.py, so every process only runs its own upkeep
+SCHEDULER.start()
+SCHEDULER.schedule('refresh-tokens', CLIENTS.refresh_expiring, 60)
+SCHEDULER.schedule('expire-sessions', expire_sessions, 3600)
+SCHEDULER.schedule('expire-jobs', JOBS.expire, 60)
+
 # --- Routable functions ---
-# Manages the request context
-@app.context_processor
-def context_processor():
-    return dict(session)
+# Starts timing a request and counts the work done for it towards its route
+@app.before_request
+def start_request_metrics():
+    g.request_start = time.perf_counter()
+    METRIC_SOURCE.set(request.endpoint or "unknown")
+    REQUEST_TIMINGS.set([])
+    SPOTIFY_PRIORITY.set(PRIORITY_INTERACTIVE) # Someone is waiting for the page
+
+
+# Records how long a request took and, if enabled, tells the browser how much of it was spent on Spotify and the database
+@app.after_request
+def finish_request_metrics(response):
+    seconds = time.perf_counter() - g.request_start
+    labels = {'route': request.endpoint or "unknown", 'method': request.method}
+    METRICS.increment("spotihelp_http_requests_total", dict(labels, status=str(response.status_code)))
+    METRICS.observe("spotihelp_http_request_seconds", labels, seconds)
+
+    # Concurrent calls are added up, so the Spotify time can be longer than the whole request
+    if SERVER_TIMING:
+        timings = REQUEST_TIMINGS.get() or []
+        server_timing = []
+        for kind in ['spotify', 'db']:
+            durations = [duration for timing_kind, duration in timings if timing_kind == kind]
+            server_timing.append(f'{kind};desc="{len(durations)} calls";dur={sum(durations) * 1000:.1f}')
+        server_timing.append(f"total;dur={seconds * 1000:.1f}")
+        response.headers['Server-Timing'] = ", ".join(server_timing)
+
+    return response
+
+
+# Answers right away when Spotify asked for a long pause, instead of holding the page until it is over
+@app.errorhandler(SpotifyBusy)
+def spotify_busy(e):
+    return render_template("error.html", msg="Spotify is busy right now, try again in a minute."), 503, {'Retry-After': str(math.ceil(e.retry_after))}
+
+
+# Exposes the request, Spotify, database and job metrics for Prometheus to scrape
+@app.route("/metrics")
+def metrics():
+    return METRICS.render(), 200, {'Content-Type': "text/plain; version=0.0.4; charset=utf-8"}
 
 
 # Has the user log in and authorize SpotiHelp to use information from Spotify
@@ -438,20 +2153,18 @@ def login():
 @app.route("/", methods=["GET", "POST"])
 def index():
     if request.method == "POST":
-        name = request.form.get("search")
+        return render_template("index.html", results=search_artists(request.form.get("search", "")))
 
-        spotify = spotipy.Spotify(client_credentials_manager=SpotifyClientCredentials())
+    else:
+        return render_template("index.html")
 
-        results = spotify.search(q='artist:' + name, type='artist')
-        items = results['artists']['items']
-        if len(items) > 0:
-            artist = items[0]
-            print(artist['name'], artist['images'][0]['url'])
 
-        return render_template("index.html", results=results['artists']['items'])
+# Returns the names, ids and thumbnails of the artists matching a search as JSON, for suggestions while the user types
+@app.route("/search/artists")
+def search_artists_typeahead():
+    artists = search_artists(request.args.get("q", ""))
 
-    else:
-        return render_template("index.html")
+    return jsonify({'artists': [{'id': artist['id'], 'name': artist['name'], 'image': artist['image']} for artist in artists]})
 
 
 # Redirects user after logging in and adds them to the user database
@@ -462,8 +2175,7 @@ def redirectPage():
     
     code = request.args.get('code') # Gets code from response URL
     token_info = sp_oauth.get_access_token(code) # Uses code sent from Spotify to exchange for an access & refresh token
-    session["token_info"] = token_info # Saves token info into the the session
-    sp = create_sp()
+    sp = PooledSpotify(auth=token_info['access_token'])
     session["username"] = sp.current_user()['display_name'] # Sets session username
     #session["user_id"] = generate_password_hash(session["username"],method='pbkdf2:sha256', salt_length=8) # Generate unique id for user
 
@@ -472,6 +2184,8 @@ def redirectPage():
         db.execute('INSERT INTO users (username) VALUES (?);', session["username"])
 
     session["user_id"] = db.execute("SELECT id FROM users WHERE username=?", session["username"])[0]['id'] # Sets session user id
+    store_token(session["user_id"], token_info) # Lets background jobs act for the user
+    CLIENTS.add(session["user_id"], token_info) # Gives the user a pooled spotify object with the new token
         
     return redirect(url_for("index", _external=True))
 
@@ -513,6 +2227,14 @@ def new_playlist():
         playlist_options.update({"auto_delete": [request.form.get("playlist_auto_delete"), request.form.get("playlist_auto_delete_skips_req")]})
         playlist_options.update({"allow_explicit": request.form.get("playlist_allow_explicit")})
 
+        # Optional key, mode and tempo bounds for the tracks picked from the ones the app already knows
+        keys = [int(key) for key in re.split(r"[\s,]+", request.form.get("playlist_keys", "")) if key.isdigit() and int(key) < 12]
+        playlist_options.update({"keys": keys or None})
+        playlist_options.update({"mode": int(request.form.get("playlist_mode")) if request.form.get("playlist_mode") in ("0", "1") else None})
+        min_tempo = request.form.get("playlist_min_tempo", type=float)
+        max_tempo = request.form.get("playlist_max_tempo", type=float)
+        playlist_options.update({"tempo": [min_tempo, max_tempo] if min_tempo is not None or max_tempo is not None else None})
+
         # Parses information
         if playlist_options['auto_add'][0] == None:
             playlist_options['auto_add'][0] = False
@@ -548,70 +2270,54 @@ def new_playlist_create():
     sp = create_sp() # Creates a new spotify object
     playlist_options = session['playlist_options']
 
-    # If the user confirms their options
+    # If the user confirms their options, creates the playlist in the background and lets the page follow its progress
     if request.method == "POST":
-        total_tracks = set() # A set of unique tracks to be added to the new playlist
-        fail_count = 0
-        recs_list = []
-        past_recs = None
-
-        # Populates playlist with unique tracks
-        while len(total_tracks) < playlist_options['size'] and fail_count < 6:
-            # Gets a batch of seeded tracks from Spotify
-            recs_dict = sp.recommendations(seed_artists=None, seed_genres=None, seed_tracks=[playlist_options['seed_track']],
-                                                limit=(playlist_options['size'] - len(total_tracks) if playlist_options['size'] - len(total_tracks) < 50 else 50), country=None)['tracks']
-            
-            # Converts the needed values from the dictonary into a list
-            for rec in recs_dict:
-                recs_list.append(rec['id'])
-            recs_list.sort()
-
-            # Makes sure there is no infinite loop 
-            if past_recs == recs_list:
-                fail_count += 1
-            past_recs = recs_list
-            past_recs.sort()
-
-            # Adds batch tracks into the total set
-            total_tracks |= set(recs_list)
-            
-        # Creates a new empty playlist with user parameters
-        new_playlist = sp.user_playlist_create(session['username'], playlist_options['name'], public=session['playlist_options']['public'], description=session['playlist_options']['description'])
-
-        # Adds tracks to playlist
-        batch = []
-        total_tracks_list = list(total_tracks) # Converts the set into a list
-
-        for batchIterator in range(len(total_tracks_list)):
-            batch.append(total_tracks_list[batchIterator])
-            batchIterator += 1 
-
-            # Adds tracks in batches of 100
-            if batchIterator % 100 == 0:
-                sp.user_playlist_add_tracks(session['username'], new_playlist['id'], batch, position=None)
-                batch = []
-
-        # Adds remaining tracks (< 100)
-        if len(batch) > 0:
-            sp.user_playlist_add_tracks(session['username'], new_playlist['id'], batch, position=None)
-
-        # Stores the playlist info into database
-        db.execute("INSERT INTO playlists VALUES (?,?,?,?,?);", session['user_id'], new_playlist['id'], new_playlist['name'], new_playlist['href'], str(playlist_options['is_smart']))
-        if playlist_options['is_smart']:
-            db.execute("INSERT INTO playlist_options (user_id, playlist_id, auto_add, replace, allow_explicit) VALUES (?,?,?,?,?);", session['user_id'], new_playlist['id'], str(playlist_options['auto_add']), str(playlist_options['auto_add'][1]), str(playlist_options['auto_add'][2]))
-        store_tracks(new_playlist['id'], total_tracks_list)
-
-        # If requested, starts a new threaded process that manages the new playlist
-        if playlist_options['is_smart']:
-            manager_thread = threading.Thread(target=manage_playlist, args=[session['user_id'], new_playlist['id'], playlist_options, total_tracks, playlist_options['seed_track'], session])
-            manager_thread.start()
-            THREADS.update({f"{session['username']}_{new_playlist['id']}": [manager_thread]})
-        
-        return render_template("playlist-new-create.html", playlist_options=playlist_options, created=True)
+        job = JOBS.submit(session['user_id'], create_playlist, session['user_id'], session['username'], playlist_options)
+
+        return render_template("playlist-new-create.html", playlist_options=playlist_options, created=True, job_id=job.id)
     else:
         return render_template("playlist-new-create.html", playlist_options=playlist_options, created=False)
 
 
+# Streams the progress of one of the user's background jobs as Server-Sent Events
+# Browsers that reconnect send the id of the last event they got, and only receive the events after it
+@app.route("/jobs/<job_id>/events")
+@login_required
+def job_events(job_id):
+    job = JOBS.get(job_id)
+    if job is None or job.user_id != session['user_id']:
+        return "Job not found", 404
+
+    last_event_id = request.headers.get('Last-Event-ID', "")
+    seen = int(last_event_id) + 1 if last_event_id.isdigit() else 0
+
+    def stream(seen):
+        while True:
+            events = job.wait(seen, JOB_KEEPALIVE)
+            if not events:
+                if job.finished is not None:
+                    return
+                yield ": keep-alive\n\n" # Stops proxies from closing an idle stream
+                continue
+
+            for event, data in events:
+                yield f"id: {seen}\nevent: {event}\ndata: {json.dumps(data)}\n\n"
+                seen += 1
+
+    return Response(stream(seen), mimetype="text/event-stream", headers={'Cache-Control': "no-cache", 'X-Accel-Buffering': "no"})
+
+
+# Returns every event of one of the user's background jobs, for pages that can't follow the stream
+@app.route("/jobs/<job_id>")
+@login_required
+def job_status(job_id):
+    job = JOBS.get(job_id)
+    if job is None or job.user_id != session['user_id']:
+        return jsonify({'error': "Job not found"}), 404
+
+    return jsonify({'finished': job.finished is not None, 'events': [{'event': event, 'data': data} for event, data in job.events]})
+
+
 # Allows the user to edit existing playlists
 @app.route("/playlist-edit")
 @login_required
@@ -628,10 +2334,10 @@ def edit_playlist():
 @app.route("/playlist-edit/<playlist>")
 @login_required
 def edit_specific_playlist(playlist):
-    # Gets playlist information
+    # Gets the playlist's details without its tracks, so the top of the page is sent right away whatever the playlist's size
     sp = create_sp()
     playlist_id = playlist
-    playlist_info = sp.playlist(playlist_id)
+    playlist_info = sp.playlist(playlist_id, fields="name,images,external_urls")
 
     # Tries to get playlist art
     try:
@@ -641,14 +2347,33 @@ def edit_specific_playlist(playlist):
 
     # Parses playlist information into a list
     playlist = {'playlist_id': playlist_id, 'playlist_name': playlist_info['name'], 
-                'playlist_art': playlist_art, 'playlist_link': playlist_info['external_urls']['spotify'], 
-                'tracks': []}
-    
-    # Gets tracks on the playlist
-    for track in playlist_info['tracks']['items']:
-        playlist['tracks'].append(track)
+                'playlist_art': playlist_art, 'playlist_link': playlist_info['external_urls']['spotify']}
+
+    # The first page of tracks is only fetched once the template reaches it, later pages are loaded by the page itself
+    page = {'next_offset': None}
+    def first_page():
+        tracks, page['next_offset'] = get_editor_page(sp, playlist_id, 0)
+        yield from tracks
+
+    return stream_template("playlist-edit-specific.html", playlist=playlist, tracks=first_page(), page=page)
+
+
+# Returns a page of a playlist's tracks for the editor as JSON, with only the fields it shows
+@app.route("/playlist-edit/<playlist>/tracks")
+@login_required
+def edit_specific_playlist_tracks(playlist):
+    offset = request.args.get("offset", 0, type=int)
+    tracks, next_offset = get_editor_page(create_sp(), playlist, max(offset, 0))
+
+    return jsonify({'tracks': [track.to_dict() for track in tracks], 'next_offset': next_offset})
+
 
-    return render_template("playlist-edit-specific.html", playlist=playlist)
+# Returns a page of a playlist's tracks in the editor's compact format, and the offset of the next page if there is one
+def get_editor_page(sp, playlist_id, offset):
+    page = sp.playlist_items(playlist_id, fields=f"items({TRACK_FIELDS}),next", limit=EDITOR_PAGE_SIZE, offset=offset, additional_types=("track",))
+    tracks = [track for track in map(Track.from_item, page['items']) if track]
+
+    return tracks, offset + EDITOR_PAGE_SIZE if page['next'] else None
 
 
 # Displays the user's listening habits
@@ -659,87 +2384,35 @@ def edit_specific_playlist(playlist):
 def show_user_data():
     sp = create_sp()
 
-    # If the user wants to add another source for their listening habits
+    # If the user wants to add, refresh or remove a source for their listening habits
     # TODO Add funcionality to add multiple playlists at one time
     if request.method == "POST":
-        sources = [] # Sources currently being added
-        db_sources = [] # Sources that were already in the database
-        sources.append(request.form.get("playlist_ids")) # A list of playlists user wants to add as sources
+        source_id = parse_source(request.form.get("playlist_ids"))
 
-        # Gets total playlists currently being used as sources
-        try:
-            total_playlists = len(sources) + db.execute("SELECT total_sources FROM user_data WHERE user_id=?;", session['user_id'])[0]['total_sources'] # Number of playlists
-        except:
-            total_playlists = len(sources)
-        
-        # Gets a list of the current sources used
-        try:
-            db_sources = json.loads(db.execute("SELECT sources FROM user_data WHERE user_id=?;", session['user_id'])[0]['sources'])
-        except:
-            pass
-        
-        """# Makes sure the user can't enter a source that's already being used
-        for source in sources:
-            if source in db_sources:
-                sources.remove(source)
-                print(f"{source} was not added!")"""
-
-        # Appends database sources if the list is not empty
-        if db_sources != []:
-            sources.extend(db_sources)
-
-        # An empty dict to store user's listening tendencies
-        user_data = {
-            "audio_features": {
-                "mode": 0,
-                "key": 0,
-                "valence": 0,
-                "speechiness": 0,
-                "instrumentalness": 0,
-                "loudness": 0,
-                "energy": 0,
-                "danceability": 0,
-                "acousticness": 0,
-                "liveness": 0,
-                "tempo": 0
-            },
-            "favorite": {
-                "artist": "",
-                "track": "",
-                "genre": ""
-            }
-        } 
-
-        # Loops through user's playlist sources and merges values
-        for playlist_id in sources:
-            new_data = get_user_data(playlist_id)['audio_features']
-            for feature in user_data['audio_features']:
-                user_data['audio_features'][feature] += new_data[feature]
-        
-        # Gets averages for each feature
-        for feature in user_data['audio_features']:
-            user_data['audio_features'][feature] /= total_playlists
+        # Only the tracks that changed since the source was last added are analyzed
+        if request.form.get("remove"):
+            track_ids = []
+        else:
+            track_ids = [track.id for track in get_tracks(source_id)]
+        update_profile_source(session['user_id'], source_id, track_ids)
 
-        # Updates and pulls from database
-        db.execute("INSERT INTO user_data (user_id, data, num_sources, sources) VALUES (?,?,?,?);", session['user_id'], json.dumps(user_data), total_playlists, json.dumps(sources)) # Updates user data
-        user_data = db.execute("SELECT * FROM user_data WHERE user_id=?;", session['user_id']) # Gets updated user data
+        # Keeps the new state of the profile in its history
+        record_profile_snapshot(session['user_id'], len(get_profile_sources(session['user_id'])))
 
         return redirect(url_for("show_user_data"))
     else:
-        current_user_playing_track = sp.current_user_playing_track()
-        current_playback = sp.current_playback()
-        currently_playing = sp.currently_playing()
-
-        print("====================================================================================================")
-        pprint(current_user_playing_track)
-        print("----------------------------------------------------------------------------------------------------")
-        pprint(current_playback)
-        print("----------------------------------------------------------------------------------------------------")
-        pprint(currently_playing)
-        print("====================================================================================================")
+        # Asks Spotify for the playback state while the page reads the database, so the page waits for that one call only
+        # The currently playing track is part of the playback state, so it isn't requested separately
+        playback = FETCH_POOL.submit(sp.current_playback)
+        playlists = db.execute("SELECT playlist_id, playlist_name FROM playlists WHERE user_id=? ORDER BY playlist_name;", session['user_id']) # Playlists synced by the editor, for the source picker
+
+        user_data = get_profile(session['user_id'])
+        sources = get_profile_sources(session['user_id'])
+
+        current_playback = playback.result()
+        currently_playing = currently_playing_from(current_playback)
 
         """user_data = []
-        playlists = get_playlists() # Gets updates list of user's current playlists
         try:
             user_data = db.execute("SELECT * FROM user_data WHERE user_id=?;", session['user_id'])[0] # Gets user data
         except:
@@ -750,4 +2423,22 @@ def show_user_data():
             user_data.append(json.loads(data['sources']))
             user_data.append(json.loads(data['data']))"""
 
-        return render_template("show-user-data.html", current_user_playing_track=current_user_playing_track, current_playback=current_playback, currently_playing=currently_playing)
\ No newline at end of file
+        return render_template("show-user-data.html", current_user_playing_track=currently_playing, current_playback=current_playback, currently_playing=currently_playing, 
+                               playlists=playlists, user_data=user_data, sources=sources)
+
+
+# Returns the history of the user's listening profile as one series per feature, for charting
+# Takes optional start and end unix times and a 'day' or 'week' bucket to roll snapshots up into
+@app.route("/data/history")
+@login_required
+def show_user_data_history():
+    start = request.args.get("start", 0, type=int)
+    end = request.args.get("end", int(time.time()), type=int)
+    bucket = request.args.get("bucket") or None
+    if bucket is not None and bucket not in HISTORY_BUCKETS:
+        return jsonify({'error': f"bucket must be one of: {', '.join(HISTORY_BUCKETS)}"}), 400
+
+    timestamps, vectors, counts = get_profile_history(session['user_id'], start, end, bucket)
+
+    return jsonify({'timestamps': timestamps.tolist(), 'snapshots': counts.tolist(), 
+                    'features': {feature: np.round(vectors[:, i].astype(np.float64), 3).tolist() for i, feature in enumerate(AUDIO_FEATURES)}})
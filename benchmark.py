@@ -0,0 +1,286 @@
+# SPOTIHELP BENCHMARKS
+# ------------------
+# Drives the main routes through Flask's test client for synthetic users of different library sizes,
+# with fake_spotify.py standing in for Spotify, and reports the wall time, Spotify API calls,
+# database queries and peak memory of every step
+#
+# Usage: python benchmark.py [--sizes N [N ...]] [--latency MS] [--output FILE] [--compare FILE] [--no-memory] [--store-tracks N]
+#
+# Peak memory is measured with tracemalloc, which slows the app down, so every scenario is run
+# a second time (with a new user and empty caches) just to measure it
+#
+
+
+import os
+import sys
+import json
+import time
+import logging
+import socket
+import argparse
+import platform
+import tempfile
+import requests
+import tracemalloc
+import subprocess
+
+from contextlib import contextmanager
+
+# Points the app at a throwaway database before it is imported
+os.environ['SPOTIHELP_DB'] = os.path.join(tempfile.mkdtemp(), "benchmark.db")
+
+import app
+import sqlalchemy
+
+# Keeps request logs out of the report, and uses a session cookie name the test client can parse
+logging.disable(logging.INFO)
+app.app.config["SESSION_COOKIE_NAME"] = "spotihelp"
+
+
+SIZES = [100, 2000, 10000] # Number of liked songs of each synthetic user
+PLAYLIST_SIZE = 100 # Number of tracks in each of the synthetic users' playlists
+NEW_PLAYLIST_SIZE = 100 # Number of tracks in the playlist created by the benchmark
+FAKE_SPOTIFY = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fake_spotify.py")
+QUERIES = [0] # Number of database queries run since the counter was last read
+
+
+# Counts every query the app sends through the cs50 database object
+@sqlalchemy.event.listens_for(app.db._engine, "before_cursor_execute")
+def count_query(conn, cursor, statement, parameters, context, executemany):
+    QUERIES[0] += 1
+
+
+# Wraps a database connection so that execute() and executemany() calls are counted
+class CountingConnection:
+    def __init__(self, connection):
+        self.connection = connection
+
+    def execute(self, *args):
+        QUERIES[0] += 1
+        return self.connection.execute(*args)
+
+    def executemany(self, *args):
+        QUERIES[0] += 1
+        return self.connection.executemany(*args)
+
+    def __getattr__(self, name):
+        return getattr(self.connection, name)
+
+
+# Counts the queries run in transactions opened with db_transaction()
+db_transaction = app.db_transaction
+
+@contextmanager
+def counting_transaction():
+    with db_transaction() as connection:
+        yield CountingConnection(connection)
+
+app.db_transaction = counting_transaction
+
+
+# Stores tracks with one committed INSERT per track, the way store_tracks() used to
+def store_tracks_per_row(user_id, playlist_id, track_list):
+    for track in track_list:
+        app.db.execute("INSERT INTO playlist_tracks (user_id, playlist_id, track_id) VALUES (?,?,?)", user_id, playlist_id, track)
+
+    return
+
+
+# Times how long it takes to store the tracks of a newly created playlist
+def benchmark_store_tracks(size):
+    user_id = app.db.execute("INSERT INTO users (username) VALUES (?);", "benchmark")
+    results = {}
+
+    for name, store in [("per row", store_tracks_per_row), ("bulk", app.store_tracks)]:
+        playlist_id = f"benchmark_{name.replace(' ', '_')}"
+        tracks = [f"{playlist_id}_{i:06}" for i in range(size)]
+        app.db.execute("INSERT INTO playlists (user_id, playlist_id, playlist_name, playlist_link, is_smart) VALUES (?,?,?,?,?);", user_id, playlist_id, name, "", "False")
+
+        start = time.perf_counter()
+        store(user_id, playlist_id, tracks)
+        results[name] = time.perf_counter() - start
+
+    return results
+
+
+# Starts fake_spotify.py in its own process, so that its work doesn't count towards the app's time and memory
+@contextmanager
+def fake_spotify(tracks, playlists, latency, username):
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+
+    process = subprocess.Popen([sys.executable, FAKE_SPOTIFY, "--tracks", str(tracks), "--playlists", str(playlists), "--playlist-size", str(PLAYLIST_SIZE),
+                                "--latency", str(latency), "--username", username, "--port", str(port)], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    stats_url = f"http://127.0.0.1:{port}/stats"
+
+    try:
+        # Waits for the fake library to be generated
+        deadline = time.time() + 60
+        while True:
+            try:
+                requests.get(stats_url, timeout=1)
+                break
+            except requests.ConnectionError:
+                if process.poll() is not None or time.time() > deadline:
+                    raise RuntimeError("fake_spotify.py did not start")
+                time.sleep(0.1)
+
+        yield f"http://127.0.0.1:{port}/v1/", stats_url
+    finally:
+        process.terminate()
+        process.wait()
+
+
+# Runs one request and measures it, failing loudly if the route errors so that broken runs aren't reported
+def measure(client, stats_url, method, path, **kwargs):
+    memory = tracemalloc.is_tracing()
+    requests.delete(stats_url)
+    QUERIES[0] = 0
+    if memory:
+        tracemalloc.reset_peak()
+        start_memory = tracemalloc.get_traced_memory()[0]
+
+    start = time.perf_counter()
+    response = client.open(path, method=method, **kwargs)
+    response.get_data() # Reads streamed responses to the end
+    seconds = time.perf_counter() - start
+
+    if response.status_code >= 400:
+        raise RuntimeError(f"{method} {path} returned {response.status_code}")
+
+    stats = requests.get(stats_url).json()
+    return {'seconds': round(seconds, 4), 'spotify_calls': stats['total_calls'], 'spotify_bytes': stats['bytes_sent'], 'db_queries': QUERIES[0],
+            'peak_memory_kb': round((tracemalloc.get_traced_memory()[1] - start_memory) / 1024) if memory else None, 'status': response.status_code}
+
+
+# Benchmarks the main routes for a new user with the given number of liked songs
+def benchmark_routes(size, latency, username):
+    playlists = max(5, size // 50)
+
+    with fake_spotify(size, playlists, latency, username) as (prefix, stats_url):
+        app.SPOTIFY_API_PREFIX = prefix
+
+        # Starts every scenario with empty caches
+        app.db.execute("DELETE FROM audio_features;")
+        app.RECOMMENDATION_CACHE.clear()
+
+        # Logs in a new user with a token that won't need refreshing
+        user_id = app.db.execute("INSERT INTO users (username) VALUES (?);", username)
+        app.store_token(user_id, {'access_token': "benchmark", 'refresh_token': "benchmark", 'expires_at': int(time.time()) + 86400})
+
+        client = app.app.test_client()
+        with client.session_transaction() as session:
+            session['user_id'] = user_id
+            session['username'] = username
+
+        steps = {}
+        steps['GET /playlist-edit'] = measure(client, stats_url, "GET", "/playlist-edit")
+        steps['GET /playlist-edit (unchanged)'] = measure(client, stats_url, "GET", "/playlist-edit")
+
+        playlist_id = app.db.execute("SELECT playlist_id FROM playlists WHERE user_id=? LIMIT 1;", user_id)[0]['playlist_id']
+        steps['GET /playlist-edit/<playlist>'] = measure(client, stats_url, "GET", f"/playlist-edit/{playlist_id}")
+
+        steps['POST /data (liked songs)'] = measure(client, stats_url, "POST", "/data", data={'playlist_ids': "liked songs"})
+        steps['POST /data (liked songs, unchanged)'] = measure(client, stats_url, "POST", "/data", data={'playlist_ids': "liked songs"})
+        steps['POST /data (playlist)'] = measure(client, stats_url, "POST", "/data", data={'playlist_ids': playlist_id})
+        steps['GET /data'] = measure(client, stats_url, "GET", "/data")
+
+        # Creates a plain playlist, as a smart one would have background jobs calling the fake Spotify
+        seed_track = requests.get(prefix + "me/tracks?limit=1").json()['items'][0]['track']['id']
+        with client.session_transaction() as session:
+            session['playlist_options'] = {'name': "Benchmark", 'public': False, 'description': "", 'seed_track': seed_track, 'size': NEW_PLAYLIST_SIZE,
+                                           'auto_add': [False, False, 3600], 'auto_delete': [False, None], 'allow_explicit': None, 'is_smart': False}
+        steps['POST /playlist-new/create'] = measure(client, stats_url, "POST", "/playlist-new/create")
+
+        # Follows the creation job the request started until it ends
+        job_id = next(job.id for job in reversed(list(app.JOBS.jobs.values())) if job.user_id == user_id)
+        steps['GET /jobs/<job>/events'] = measure(client, stats_url, "GET", f"/jobs/{job_id}/events")
+        if app.JOBS.get(job_id).events[-1][0] != 'done':
+            raise RuntimeError("playlist creation job failed")
+
+    return {'tracks': size, 'playlists': playlists, 'steps': steps}
+
+
+# Benchmarks a library size, then runs it again with tracemalloc to add the peak memory of each step
+def benchmark_scenario(size, latency, memory):
+    scenario = benchmark_routes(size, latency, f"benchmark-{size}")
+
+    if memory:
+        tracemalloc.start()
+        traced = benchmark_routes(size, latency, f"benchmark-{size}-traced")
+        tracemalloc.stop()
+
+        for name, step in scenario['steps'].items():
+            step['peak_memory_kb'] = traced['steps'][name]['peak_memory_kb']
+
+    steps = scenario['steps'].values()
+    scenario['total'] = {'seconds': round(sum(step['seconds'] for step in steps), 4), 'spotify_calls': sum(step['spotify_calls'] for step in steps),
+                         'spotify_bytes': sum(step['spotify_bytes'] for step in steps),
+                         'db_queries': sum(step['db_queries'] for step in steps), 'peak_memory_kb': max(step['peak_memory_kb'] for step in steps) if memory else None}
+
+    return scenario
+
+
+# Returns the commit being benchmarked, if there is one
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+# Prints a table of every step of every scenario, with the change from an earlier run if one is given
+def report(results, baseline=None):
+    columns = ['seconds', 'spotify_calls', 'spotify_bytes', 'db_queries', 'peak_memory_kb']
+    print(f"{'step':<40}" + "".join(f"{column:>22}" for column in columns))
+
+    for size, scenario in results['scenarios'].items():
+        print(f"--- {size} tracks, {scenario['playlists']} playlists ---")
+        old_steps = dict(baseline['scenarios'].get(size, {}).get('steps', {}), total=baseline['scenarios'].get(size, {}).get('total')) if baseline else {}
+
+        for name, step in dict(scenario['steps'], total=scenario['total']).items():
+            line = f"{name:<40}"
+            for column in columns:
+                value = step[column]
+                old = (old_steps.get(name) or {}).get(column)
+                if value is not None and old:
+                    line += f"{value:>13} ({(value - old) / old:+6.0%})"
+                else:
+                    line += f"{str(value):>22}"
+            print(line)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmarks SpotiHelp's main routes against a fake Spotify")
+    parser.add_argument("--sizes", type=int, nargs="+", default=SIZES, help="numbers of liked songs of the synthetic users")
+    parser.add_argument("--latency", type=float, default=20, help="milliseconds the fake Spotify takes to answer each request")
+    parser.add_argument("--output", default="benchmark-results.json", help="file the results are saved to")
+    parser.add_argument("--compare", help="results of an earlier run to compare against")
+    parser.add_argument("--no-memory", action="store_true", help="skip the second run of every scenario that measures memory")
+    parser.add_argument("--store-tracks", type=int, help="also compare storing this many tracks row by row and in bulk")
+    args = parser.parse_args()
+
+    memory = not args.no_memory
+    results = {'commit': git_commit(), 'date': time.strftime("%Y-%m-%dT%H:%M:%S"), 'python': platform.python_version(),
+               'latency_ms': args.latency, 'memory_traced': memory, 'scenarios': {}}
+    for size in args.sizes:
+        results['scenarios'][str(size)] = benchmark_scenario(size, args.latency, memory)
+
+    if args.store_tracks:
+        store_results = benchmark_store_tracks(args.store_tracks)
+        results['store_tracks'] = {'tracks': args.store_tracks, 'per_row_seconds': round(store_results['per row'], 4), 'bulk_seconds': round(store_results['bulk'], 4)}
+
+    with open(args.output, "w") as file:
+        json.dump(results, file, indent=2)
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as file:
+            baseline = json.load(file)
+
+    report(results, baseline)
+    if args.store_tracks:
+        print(f"store_tracks ({args.store_tracks} tracks): {store_results['per row'] * 1000:.1f} ms per row, {store_results['bulk'] * 1000:.1f} ms in bulk")
+    print(f"Saved to {args.output}")
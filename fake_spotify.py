@@ -0,0 +1,447 @@
+# SPOTIHELP FAKE SPOTIFY
+# ------------------
+# A local stand-in for the parts of the Spotify Web API that SpotiHelp uses,
+# so that the app can be run and measured without a Spotify account
+#
+# Usage: python fake_spotify.py [--tracks N] [--playlists N] [--playlist-size N] [--latency MS] [--rate-limit N] [--username NAME] [--seed N] [--port PORT]
+# Then start SpotiHelp with SPOTIFY_API_PREFIX=http://localhost:PORT/v1/
+#
+
+
+import os
+import re
+import ast
+import json
+import math
+import time
+import random
+import hashlib
+import argparse
+import threading
+
+from collections import Counter
+from flask import Flask, request, jsonify, Response
+from werkzeug.serving import make_server
+
+
+FIXTURES_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "json-response.txt")
+BASE62 = "0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz"
+FEATURE_RANGES = {'danceability': (0, 1), 'energy': (0, 1), 'loudness': (-30, 0), 'speechiness': (0, 1), 'acousticness': (0, 1),
+                  'instrumentalness': (0, 1), 'liveness': (0, 1), 'valence': (0, 1), 'tempo': (60, 200)} # Ranges of generated audio features
+
+
+# Loads the example responses recorded in json-response.txt, keyed by section name
+def load_fixtures(path=FIXTURES_PATH):
+    fixtures = {}
+    sections = re.split(r"^== (.+) ==$", open(path, encoding="utf-8").read(), flags=re.M)
+
+    # Each section holds one or more examples, either as JSON or as printed Python dicts
+    for name, body in zip(sections[1::2], sections[2::2]):
+        for block in re.split(r"\n\s*\n", body):
+            for parse in (json.loads, ast.literal_eval):
+                try:
+                    fixtures[name] = parse(block.strip())
+                    break
+                except (ValueError, SyntaxError):
+                    pass
+            if name in fixtures:
+                break
+
+    return fixtures
+
+
+# Returns a 22 character id that is always the same for the same name, like the ids Spotify uses
+def make_id(name):
+    number = int(hashlib.md5(name.encode()).hexdigest(), 16)
+    digits = []
+    for i in range(22):
+        number, digit = divmod(number, 62)
+        digits.append(BASE62[digit])
+
+    return "".join(digits)
+
+
+# Parses a Spotify 'fields' filter such as "items(track(id,name)),total" into a nested dict
+def parse_fields(spec):
+    def parse(i):
+        fields = {}
+        name = ""
+        while i < len(spec):
+            if spec[i] == ",":
+                if name:
+                    add(fields, name, None)
+                name = ""
+                i += 1
+            elif spec[i] == "(":
+                sub_fields, i = parse(i + 1)
+                add(fields, name, sub_fields)
+                name = ""
+            elif spec[i] == ")":
+                if name:
+                    add(fields, name, None)
+                return fields, i + 1
+            else:
+                name += spec[i]
+                i += 1
+        if name:
+            add(fields, name, None)
+        return fields, i
+
+    # Supports the dotted form too, as in "items.track.name"
+    def add(fields, name, sub_fields):
+        parts = name.split(".")
+        for part in parts[:-1]:
+            fields = fields.setdefault(part, {})
+        fields[parts[-1]] = sub_fields
+
+    return parse(0)[0]
+
+
+# Keeps only the requested fields of a response
+def apply_fields(value, fields):
+    if fields is None:
+        return value
+    if isinstance(value, list):
+        return [apply_fields(item, fields) for item in value]
+    if isinstance(value, dict):
+        return {key: apply_fields(value[key], sub_fields) for key, sub_fields in fields.items() if key in value}
+    return value
+
+
+# Limits how many requests are answered per second, like Spotify's rolling rate limit
+class RateLimit:
+    def __init__(self, rate):
+        self.rate = rate
+        self.tokens = rate
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    # Returns 0 if the request may go ahead, or the number of seconds the client should wait
+    def take(self):
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0
+            return (1 - self.tokens) / self.rate
+
+
+# A generated user library built from the recorded example responses
+class FakeSpotify:
+    def __init__(self, tracks=100, playlists=10, playlist_size=50, catalog=None, latency_ms=0, rate_limit=None, username="spotihelp-fake", seed=0):
+        self.fixtures = load_fixtures()
+        self.random = random.Random(seed)
+        self.username = username
+        self.latency_ms = latency_ms
+        self.rate_limit = RateLimit(rate_limit) if rate_limit else None
+        self.lock = threading.Lock()
+        self.calls = Counter() # Endpoint -> number of requests
+        self.bytes_sent = 0
+        self.throttled = 0
+
+        # Tracks that can be recommended, the first ones being the user's liked songs
+        template = self.fixtures['SAVED TRACKS']['items'][0]
+        self.catalog = [self.make_track(template['track'], i) for i in range(max(catalog or 0, tracks, playlist_size * 2, 1000))]
+        self.tracks = {track['id']: track for track in self.catalog}
+        self.saved_tracks = [{'added_at': time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(1600000000 - i * 3600)), 'track': track}
+                             for i, track in enumerate(self.catalog[:tracks])]
+        self.features = {}
+        self.playlists = {}
+        for i in range(playlists):
+            self.create_playlist(f"Playlist {i}", track_ids=[track['id'] for track in self.random.sample(self.catalog, playlist_size)])
+
+        self.artists = {}
+        for track in self.catalog:
+            for artist in track['artists']:
+                self.artists.setdefault(artist['id'], artist)
+
+    # Copies the recorded track with a new id, name and artist
+    def make_track(self, template, i):
+        track_id = make_id(f"track {i}")
+        artist_id = make_id(f"artist {i % 500}")
+        artist = {'external_urls': {'spotify': f"https://open.spotify.com/artist/{artist_id}"}, 'href': f"https://api.spotify.com/v1/artists/{artist_id}",
+                  'id': artist_id, 'name': f"Artist {i % 500}", 'type': 'artist', 'uri': f"spotify:artist:{artist_id}"}
+
+        track = dict(template)
+        track.update({'id': track_id, 'name': f"Track {i}", 'artists': [artist], 'uri': f"spotify:track:{track_id}",
+                      'href': f"https://api.spotify.com/v1/tracks/{track_id}", 'external_urls': {'spotify': f"https://open.spotify.com/track/{track_id}"}})
+        return track
+
+    # Returns made up (but always the same) audio features for a track
+    def audio_features(self, track_id):
+        if track_id not in self.tracks:
+            return None
+
+        if track_id not in self.features:
+            generator = random.Random(track_id)
+            features = dict(self.fixtures['FRICK'])
+            features.update({feature: round(generator.uniform(*bounds), 4) for feature, bounds in FEATURE_RANGES.items()})
+            features.update({'key': generator.randrange(12), 'mode': generator.randrange(2), 'id': track_id, 'uri': f"spotify:track:{track_id}"})
+            self.features[track_id] = features
+
+        return self.features[track_id]
+
+    # Creates a playlist owned by the user
+    def create_playlist(self, name, public=True, description="", track_ids=()):
+        template = self.fixtures['PLAYLISTS']['items'][0]
+        playlist_id = make_id(f"playlist {self.username} {len(self.playlists)} {name}")
+
+        playlist = dict(template)
+        playlist.update({'id': playlist_id, 'name': name, 'public': public, 'description': description, 'images': [],
+                         'owner': dict(template['owner'], id=self.username, display_name=self.username),
+                         'external_urls': {'spotify': f"https://open.spotify.com/playlist/{playlist_id}"},
+                         'href': f"https://api.spotify.com/v1/playlists/{playlist_id}", 'uri': f"spotify:playlist:{playlist_id}"})
+        self.playlists[playlist_id] = {'playlist': playlist, 'track_ids': list(track_ids), 'version': 0}
+        self.touch(playlist_id)
+
+        return playlist_id
+
+    # Gives a playlist a new snapshot id after it changed
+    def touch(self, playlist_id):
+        entry = self.playlists[playlist_id]
+        entry['version'] += 1
+        entry['playlist']['snapshot_id'] = make_id(f"{playlist_id} {entry['version']}") + "=="
+        entry['playlist']['tracks'] = {'href': f"https://api.spotify.com/v1/playlists/{playlist_id}/tracks", 'total': len(entry['track_ids'])}
+
+    # Returns a page of a playlist's tracks
+    def playlist_tracks(self, playlist_id, limit, offset):
+        track_ids = self.playlists[playlist_id]['track_ids']
+        items = [{'added_at': "2021-06-01T00:00:00Z", 'is_local': False, 'track': self.tracks[track_id]} for track_id in track_ids[offset:offset + limit]]
+        return page(items, len(track_ids), limit, offset, f"playlists/{playlist_id}/tracks")
+
+    # Returns tracks for a set of seeds, always the same for the same seeds
+    def recommendations(self, seed_tracks, limit):
+        generator = random.Random(",".join(sorted(seed_tracks)))
+        return {'seeds': [{'id': seed, 'type': 'TRACK'} for seed in seed_tracks], 'tracks': generator.sample(self.catalog, min(limit, len(self.catalog)))}
+
+    # Returns what the user is listening to, moving through their liked songs as time passes
+    def playback(self):
+        if not self.saved_tracks:
+            return None
+
+        position = int(time.time() * 1000)
+        track = self.saved_tracks[(position // 84266) % len(self.saved_tracks)]['track']
+        playlist_id = next(iter(self.playlists), None)
+
+        return {'is_playing': True, 'progress_ms': position % 84266, 'item': dict(track, duration_ms=84266), 'currently_playing_type': 'track',
+                'context': {'type': 'playlist', 'uri': f"spotify:playlist:{playlist_id}"} if playlist_id else None,
+                'device': {'id': make_id("device"), 'name': "Fake Device", 'type': 'Computer', 'volume_percent': 50, 'is_active': True},
+                'timestamp': position, 'shuffle_state': False, 'repeat_state': 'off'}
+
+
+# Returns a Spotify paging object
+def page(items, total, limit, offset, path):
+    return {'href': f"https://api.spotify.com/v1/{path}?offset={offset}&limit={limit}", 'items': items, 'limit': limit, 'offset': offset, 'total': total,
+            'next': f"https://api.spotify.com/v1/{path}?offset={offset + limit}&limit={limit}" if offset + limit < total else None,
+            'previous': f"https://api.spotify.com/v1/{path}?offset={max(offset - limit, 0)}&limit={limit}" if offset > 0 else None}
+
+
+# Returns a Spotify error response
+def spotify_error(status, message):
+    return jsonify({'error': {'status': status, 'message': message}}), status
+
+
+# Builds the web app that answers like the Spotify Web API
+def create_app(fake):
+    app = Flask(__name__)
+    app.url_map.strict_slashes = False # spotipy asks for some endpoints with a trailing slash
+
+    # Counts the request, then applies the configured latency and rate limit
+    @app.before_request
+    def before_request():
+        if not request.path.startswith("/v1/"):
+            return None
+
+        with fake.lock:
+            fake.calls[f"{request.method} {request.url_rule.rule if request.url_rule else request.path}"] += 1
+
+        if fake.latency_ms:
+            time.sleep(fake.latency_ms / 1000)
+
+        if fake.rate_limit:
+            wait = fake.rate_limit.take()
+            if wait:
+                with fake.lock:
+                    fake.throttled += 1
+                response, status = spotify_error(429, "API rate limit exceeded")
+                response.status_code = status
+                response.headers['Retry-After'] = str(math.ceil(wait))
+                return response
+
+        return None
+
+    # Adds an ETag to every successful GET and answers 304 when the client already has that version
+    @app.after_request
+    def after_request(response):
+        if request.method == "GET" and response.status_code == 200 and request.path.startswith("/v1/"):
+            etag = '"' + hashlib.md5(response.get_data()).hexdigest() + '"'
+            if request.headers.get('If-None-Match') == etag:
+                response = Response(status=304)
+            response.headers['ETag'] = etag
+
+        with fake.lock:
+            fake.bytes_sent += response.calculate_content_length() or 0
+
+        return response
+
+    # Keeps only the fields the client asked for
+    def filtered(value):
+        if request.args.get('fields'):
+            value = apply_fields(value, parse_fields(request.args['fields']))
+        return jsonify(value)
+
+    def paging_args(maximum):
+        limit = int(request.args.get('limit', 20))
+        offset = int(request.args.get('offset', 0))
+        return min(limit, maximum), offset
+
+    @app.route("/v1/me")
+    def me():
+        return jsonify({'id': fake.username, 'display_name': fake.username, 'type': 'user', 'uri': f"spotify:user:{fake.username}",
+                        'external_urls': {'spotify': f"https://open.spotify.com/user/{fake.username}"}, 'followers': {'total': 0}, 'images': []})
+
+    @app.route("/v1/me/tracks")
+    def saved_tracks():
+        limit, offset = paging_args(50)
+        return jsonify(page(fake.saved_tracks[offset:offset + limit], len(fake.saved_tracks), limit, offset, "me/tracks"))
+
+    @app.route("/v1/me/playlists")
+    @app.route("/v1/users/<user>/playlists")
+    def playlists(user=None):
+        limit, offset = paging_args(50)
+        playlists = [entry['playlist'] for entry in fake.playlists.values()]
+        return jsonify(page(playlists[offset:offset + limit], len(playlists), limit, offset, "me/playlists"))
+
+    @app.route("/v1/me/playlists", methods=["POST"])
+    @app.route("/v1/users/<user>/playlists", methods=["POST"])
+    def create_playlist(user=None):
+        body = request.get_json(force=True)
+        playlist_id = fake.create_playlist(body['name'], body.get('public', True), body.get('description', ""))
+        return jsonify(fake.playlists[playlist_id]['playlist']), 201
+
+    @app.route("/v1/playlists/<playlist_id>")
+    def playlist(playlist_id):
+        if playlist_id not in fake.playlists:
+            return spotify_error(404, "Not found.")
+        return filtered(dict(fake.playlists[playlist_id]['playlist'], tracks=fake.playlist_tracks(playlist_id, 100, 0)))
+
+    @app.route("/v1/playlists/<playlist_id>/tracks", methods=["GET", "POST", "DELETE"])
+    @app.route("/v1/playlists/<playlist_id>/items", methods=["GET", "POST", "DELETE"])
+    @app.route("/v1/users/<user>/playlists/<playlist_id>/tracks", methods=["GET", "POST", "DELETE"])
+    def playlist_tracks(playlist_id, user=None):
+        if playlist_id not in fake.playlists:
+            return spotify_error(404, "Not found.")
+        entry = fake.playlists[playlist_id]
+
+        if request.method == "GET":
+            limit, offset = paging_args(100)
+            return filtered(fake.playlist_tracks(playlist_id, limit, offset))
+
+        body = request.get_json(force=True, silent=True) or {}
+        if isinstance(body, list): # spotipy posts a bare list of uris and sends the position as a query argument
+            body = {'uris': body, 'position': request.args.get('position', type=int)}
+        if request.method == "POST":
+            uris = body.get('uris') or request.args.get('uris', "").split(",")
+            if len(uris) > 100:
+                return spotify_error(400, "Too many ids requested")
+            with fake.lock:
+                position = body.get('position')
+                new_ids = [uri.split(":")[-1] for uri in uris if uri]
+                if position is None:
+                    entry['track_ids'].extend(new_ids)
+                else:
+                    entry['track_ids'][position:position] = new_ids
+                fake.touch(playlist_id)
+        else:
+            removed = {track['uri'].split(":")[-1] for track in body.get('items', body.get('tracks', []))}
+            with fake.lock:
+                entry['track_ids'] = [track_id for track_id in entry['track_ids'] if track_id not in removed]
+                fake.touch(playlist_id)
+
+        return jsonify({'snapshot_id': entry['playlist']['snapshot_id']}), 201
+
+    @app.route("/v1/recommendations")
+    def recommendations():
+        seed_tracks = [seed for seed in request.args.get('seed_tracks', "").split(",") if seed]
+        if not seed_tracks or len(seed_tracks) > 5:
+            return spotify_error(400, "Invalid seeds")
+        return jsonify(fake.recommendations(seed_tracks, min(int(request.args.get('limit', 20)), 100)))
+
+    @app.route("/v1/audio-features")
+    def audio_features():
+        track_ids = request.args.get('ids', "").split(",")
+        if len(track_ids) > 100:
+            return spotify_error(400, "Too many ids requested")
+        return jsonify({'audio_features': [fake.audio_features(track_id) for track_id in track_ids]})
+
+    @app.route("/v1/audio-features/<track_id>")
+    def track_audio_features(track_id):
+        return jsonify(fake.audio_features(track_id))
+
+    @app.route("/v1/me/player")
+    def player():
+        playback = fake.playback()
+        return jsonify(playback) if playback else Response(status=204)
+
+    @app.route("/v1/me/player/currently-playing")
+    def currently_playing():
+        playback = fake.playback()
+        if not playback:
+            return Response(status=204)
+        return jsonify({key: playback[key] for key in ('is_playing', 'progress_ms', 'item', 'currently_playing_type', 'context', 'timestamp')})
+
+    @app.route("/v1/search")
+    def search():
+        query = request.args.get('q', "").lower().replace("artist:", "").strip()
+        limit, offset = paging_args(50)
+        artists = [dict(artist, followers={'total': 1000}, popularity=50, genres=[],
+                        images=[{'height': 640, 'width': 640, 'url': f"https://i.scdn.co/image/{artist['id']}"}])
+                   for artist in fake.artists.values() if query in artist['name'].lower()]
+        return jsonify({'artists': page(artists[offset:offset + limit], len(artists), limit, offset, "search")})
+
+    # Hands out tokens for both the client credentials and the refresh token flows
+    @app.route("/api/token", methods=["POST"])
+    def token():
+        return jsonify({'access_token': make_id(str(time.time())), 'token_type': 'Bearer', 'expires_in': 3600, 'scope': request.form.get('scope', "")})
+
+    # Lets benchmarks read and reset the request counters
+    @app.route("/stats", methods=["GET", "DELETE"])
+    def stats():
+        with fake.lock:
+            stats = {'calls': dict(fake.calls), 'total_calls': sum(fake.calls.values()), 'bytes_sent': fake.bytes_sent, 'throttled': fake.throttled}
+            if request.method == "DELETE":
+                fake.calls.clear()
+                fake.bytes_sent = 0
+                fake.throttled = 0
+        return jsonify(stats)
+
+    return app
+
+
+# Serves a fake Spotify on a background thread and returns the server and its API prefix
+def serve(fake, port=0):
+    server = make_server("127.0.0.1", port, create_app(fake), threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    return server, f"http://127.0.0.1:{server.server_port}/v1/"
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Runs a local stand-in for the Spotify Web API")
+    parser.add_argument("--tracks", type=int, default=100, help="number of liked songs")
+    parser.add_argument("--playlists", type=int, default=10, help="number of playlists owned by the user")
+    parser.add_argument("--playlist-size", type=int, default=50, help="number of tracks in each playlist")
+    parser.add_argument("--latency", type=float, default=0, help="milliseconds added to every request")
+    parser.add_argument("--rate-limit", type=float, default=None, help="requests per second before answering 429")
+    parser.add_argument("--username", default="spotihelp-fake", help="id of the fake user, who owns the generated playlists")
+    parser.add_argument("--seed", type=int, default=0, help="seed for the generated library")
+    parser.add_argument("--port", type=int, default=8888)
+    args = parser.parse_args()
+
+    fake = FakeSpotify(tracks=args.tracks, playlists=args.playlists, playlist_size=args.playlist_size, latency_ms=args.latency, rate_limit=args.rate_limit,
+                       username=args.username, seed=args.seed)
+    print(f"Fake Spotify running at http://127.0.0.1:{args.port}/v1/ as user '{fake.username}'")
+    create_app(fake).run(port=args.port, threaded=True)
@@ -0,0 +1,36 @@
+# SPOTIHELP WORKER
+# ------------------
+# Manages smart playlists outside of the web process, so that any number of web processes can be run
+#
+# Usage: python worker.py
+#
+# Each worker renews leases on its playlists in the database every LEASE_HEARTBEAT seconds and takes
+# its share of the playlists no live worker holds, so several workers split the playlists between them
+# and the playlists of a worker that crashed are taken over once its leases expire
+#
+
+
+import signal
+import threading
+
+import app
+
+
+# Stops the worker on SIGTERM (sent by the process manager) as well as on Ctrl-C
+def stop(signum, frame):
+    raise KeyboardInterrupt
+
+
+if __name__ == "__main__":
+    signal.signal(signal.SIGTERM, stop)
+    app.start_worker()
+    print(f"Worker {app.WORKER_ID} started")
+
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        # Lets other workers take this worker's playlists right away instead of waiting for the leases to expire
+        app.release_playlists()
+        print(f"Worker {app.WORKER_ID} stopped")